@@ -1,40 +1,411 @@
+import hmac
 import json
 import re
 from base64 import b64encode
+from collections import OrderedDict
 from configparser import ConfigParser
+from functools import cache
+from hashlib import sha256
 from os import environ
+from os.path import join
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import gmtime
+from time import monotonic
+from time import strftime
+from time import time
 from traceback import format_exc
+from traceback import print_exc
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl
+from urllib.parse import quote
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.request import Request
+from urllib.request import urlopen
 
 import boto3
+from boto3.dynamodb.types import Binary
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-s3_client = boto3.client("s3")
+from auth import Grants
+from auth import InvalidToken
+from auth import KeySet
+from auth import validate
+from bloom import BloomFilter
+from metrics import Metrics
+from metrics import profiled
 
 parser = ConfigParser()
 parser.read(environ["LAMBDA_TASK_ROOT"] + "/config.ini")
 config = parser["default"]
 BUCKET_NAME = config["bucket"]
 
-MATCHER = re.compile("v2/(.*)/(manifests|blobs)/([^/]+)$")
+# Endpoints may be pointed at local stand-ins for S3 and DynamoDB
+S3_ENDPOINT = config.get("s3_endpoint")
+CLIENT_CONFIG = Config(
+    max_pool_connections=config.getint("max_pool_connections", fallback=10)
+)
+# The fraction of invocations to profile with cProfile
+PROFILE_SAMPLE_RATE = config.getfloat("profile_sample_rate", fallback=0.0)
+METRICS = Metrics("app")
+session = boto3.session.Session()
+# Serializes client creation, which isn't thread-safe on a shared session
+CLIENT_LOCK = Lock()
 
-MANIFESTS_TABLE = boto3.resource("dynamodb").Table(config["manifests"])
 
+def _create_client(service_name, endpoint_url):
+    with CLIENT_LOCK:
+        client = session.client(
+            service_name, endpoint_url=endpoint_url, config=CLIENT_CONFIG
+        )
+
+    return METRICS.instrument(client)
+
+
+# Every request that gets past routing reads DynamoDB, so its client is created
+# during Lambda init. Low-level clients are used throughout: loading boto3's
+# resource models is a large share of a cold start.
+dynamodb_client = _create_client("dynamodb", config.get("dynamodb_endpoint"))
+DESERIALIZER = TypeDeserializer()
+
+
+@cache
+def s3_client():
+    """S3 is only needed for some requests, so its client is created on first use."""
+    return _create_client("s3", S3_ENDPOINT)
+
+
+def _unmarshal(item):
+    return {k: DESERIALIZER.deserialize(v) for k, v in item.items()}
+
+
+# Names, tags and digests follow the distribution spec's grammar, since they
+# end up in bucket keys and in upstream URLs.
+PATH_COMPONENT = "[a-z0-9]+(?:(?:[._]|__|-+)[a-z0-9]+)*"
+REPOSITORY = f"{PATH_COMPONENT}(?:/{PATH_COMPONENT})*"
+MAX_REPOSITORY_LENGTH = 255
+MATCHER = re.compile(f"v2/({REPOSITORY})/(manifests|blobs|tags)/([^/]+)$")
+TAG = re.compile(r"\w[\w.-]{0,127}")
+DIGEST = re.compile("[a-z0-9]+(?:[.+_-][a-z0-9]+)*:[a-zA-Z0-9=_-]+")
+
+MANIFESTS_TABLE = config["manifests"]
+REPOSITORIES_TABLE = config["repositories"]
+BLOBS_TABLE = config["blobs"]
+# A GSI on the manifests table, keyed by (repository, tag)
+TAGS_INDEX = "tags"
+# The partition key of every row in the repositories table
+CATALOG = "default"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class LRUCache:
+    """A bounded, least-recently-used mapping. Entries may carry a TTL.
+
+    By default the bound is on the number of entries; pass `weigh` to bound the
+    sum of `weigh(value)` instead. Caches with a `name` count their hits and
+    misses as `<name>.Hits` and `<name>.Misses` metrics.
+    """
+
+    def __init__(self, maxsize, weigh=None, name=None):
+        self._maxsize = maxsize
+        self._weigh = weigh or (lambda value: 1)
+        self._size = 0
+        self._entries = OrderedDict()
+        # The standalone server routes requests on several threads
+        self._lock = Lock()
+        self._name = name
+
+    def _evict(self, key):
+        _, _, weight = self._entries.pop(key)
+        self._size -= weight
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key)
+
+        if self._name is not None:
+            METRICS.count(self._name + (".Misses" if value is None else ".Hits"))
+        return value
+
+    def _get(self, key):
+        try:
+            value, expires, _ = self._entries[key]
+        except KeyError:
+            return None
+
+        if expires is not None and expires <= monotonic():
+            self._evict(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl=None):
+        weight = self._weigh(value)
+        if weight > self._maxsize:
+            return
+
+        with self._lock:
+            self._put(key, value, weight, ttl)
+
+    def _put(self, key, value, weight, ttl):
+        if key in self._entries:
+            self._evict(key)
+
+        expires = None if ttl is None else monotonic() + ttl
+        self._entries[key] = (value, expires, weight)
+        self._size += weight
+        while self._size > self._maxsize:
+            self._evict(next(iter(self._entries)))
+
+
+# Lives for the lifetime of a warm container. Digest-addressed manifests are
+# immutable and never expire; tags can move, so they are only cached briefly.
+MANIFEST_CACHE = LRUCache(
+    config.getint("manifest_cache_size", fallback=1024), name="ManifestCache"
+)
+TAG_CACHE_TTL = config.getfloat("tag_cache_ttl", fallback=5.0)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Blobs up to this size are served from the function rather than redirected to
+# S3, saving clients a connection and a round trip. 0 disables this.
+INLINE_BLOB_LIMIT = config.getint("inline_blob_limit", fallback=65536)
+BLOB_SIZES = LRUCache(
+    config.getint("blob_size_cache_size", fallback=16384), name="BlobSizes"
+)
+# Blobs without a size in the blobs table are only looked up again after this
+BLOB_MISS_TTL = config.getfloat("blob_miss_ttl", fallback=5.0)
+MISSING_SIZE = -1
+# Blobs that served manifests list as too big to inline, which are redirected
+# without looking up their size
+LARGE_BLOBS = LRUCache(config.getint("blob_size_cache_size", fallback=16384))
+BLOB_CACHE = LRUCache(
+    config.getint("blob_cache_bytes", fallback=32 * 1024 * 1024),
+    weigh=len,
+    name="BlobCache",
+)
+
+# Blob redirects are signed as of the start of a fixed window, so that every
+# request for a blob within a window gets the same URL and proxies can cache it.
+PRESIGN_WINDOW = config.getint("presign_window", fallback=300)
+PRESIGNED_URLS = LRUCache(config.getint("presigned_url_cache_size", fallback=4096))
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode(), sha256).digest()
+
+
+def presign(method, key, signed_at, expires_in, credentials, region):
+    """Presigns an S3 request with SigV4 query parameters, as of `signed_at`.
+
+    botocore always signs as of the current time, hence doing it ourselves.
+    """
+
+    timestamp = strftime("%Y%m%dT%H%M%SZ", gmtime(signed_at))
+    datestamp = timestamp[:8]
+    scope = f"{datestamp}/{region}/s3/aws4_request"
+    if S3_ENDPOINT:
+        # Local stand-ins generally only understand path-style addressing
+        endpoint = urlsplit(S3_ENDPOINT)
+        scheme, host = endpoint.scheme, endpoint.netloc
+        path = quote(f"/{BUCKET_NAME}/{key}", safe="/-_.~")
+    else:
+        scheme, host = "https", f"{BUCKET_NAME}.s3.{region}.amazonaws.com"
+        path = quote("/" + key, safe="/-_.~")
+
+    params = {
+        "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+        "X-Amz-Credential": f"{credentials.access_key}/{scope}",
+        "X-Amz-Date": timestamp,
+        "X-Amz-Expires": str(expires_in),
+        "X-Amz-SignedHeaders": "host",
+    }
+    if credentials.token:
+        params["X-Amz-Security-Token"] = credentials.token
+    query = "&".join(
+        f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}"
+        for k, v in sorted(params.items())
+    )
+
+    canonical_request = "\n".join(
+        [method, path, query, f"host:{host}\n", "host", "UNSIGNED-PAYLOAD"]
+    )
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            timestamp,
+            scope,
+            sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+
+    signing_key = ("AWS4" + credentials.secret_key).encode()
+    for part in (datestamp, region, "s3", "aws4_request"):
+        signing_key = _hmac(signing_key, part)
+    signature = hmac.new(signing_key, string_to_sign.encode(), sha256).hexdigest()
+
+    return f"{scheme}://{host}{path}?{query}&X-Amz-Signature={signature}"
+
+
+def presigned_blob_url(method, digest, now):
+    """Returns the URL for a blob in the window containing `now`, and how many
+    seconds remain in that window."""
+
+    window_start = int(now) - int(now) % PRESIGN_WINDOW
+    credentials = session.get_credentials().get_frozen_credentials()
+
+    # Credentials rotate, and a URL can't outlive the ones that signed it
+    memo_key = (digest, method, window_start, credentials.access_key)
+    url = PRESIGNED_URLS.get(memo_key)
+    if url is None:
+        # Valid until the end of the following window, so that a URL handed out
+        # at the end of its window still has time to be used.
+        with METRICS.timed("Presign"):
+            url = presign(
+                method,
+                "blobs/" + digest,
+                window_start,
+                2 * PRESIGN_WINDOW,
+                credentials,
+                session.region_name,
+            )
+        PRESIGNED_URLS.put(memo_key, url)
+
+    return url, window_start + PRESIGN_WINDOW - int(now)
+
+
+NAME_FILTER_KEY = "filters/manifest-names"
+# Tags the indexer created since it last published the filter
+RECENT_NAMES_KEY = "filters/manifest-names-recent"
+
+
+class NameFilter:
+    """The indexer's Bloom filter of tag names, refreshed in the background.
+
+    Tags created since the filter was published are listed separately by the
+    indexer before they are indexed. A name missing from both makes the list be
+    read again, at most every `recheck_interval` seconds, so a new tag can only
+    be turned away for that long after it is indexed. A filter older than
+    `max_age` seconds is ignored altogether.
+    """
+
+    def __init__(self, refresh_interval, recheck_interval, max_age):
+        self._refresh_interval = refresh_interval
+        self._recheck_interval = recheck_interval
+        self._max_age = max_age
+        self._filter = None
+        self._recent = frozenset()
+        self._recent_etag = None
+        self._checked = self._rechecked = monotonic()
+        self._refreshing = False
+        self._lock = Lock()
+
+    def refresh(self):
+        self.refresh_recent()
+        try:
+            blob = s3_client().get_object(Bucket=BUCKET_NAME, Key=NAME_FILTER_KEY)
+        except s3_client().exceptions.NoSuchKey:
+            return
+
+        loaded = BloomFilter.loads(blob["Body"].read())
+        current = self._filter
+        if current is None or loaded.generation > current.generation:
+            self._filter = loaded
 
-def _get_actual_manifest(repository, image):
+    def refresh_recent(self):
+        kwargs = dict(IfNoneMatch=self._recent_etag) if self._recent_etag else dict()
+        try:
+            resp = s3_client().get_object(
+                Bucket=BUCKET_NAME, Key=RECENT_NAMES_KEY, **kwargs
+            )
+        except ClientError as e:
+            status = e.response["ResponseMetadata"]["HTTPStatusCode"]
+            if status == 304:
+                return
+            # Without s3:ListBucket, missing objects are a 403 rather than a 404
+            if status not in (403, 404):
+                raise
+            self._recent, self._recent_etag = frozenset(), None
+            return
+
+        self._recent = frozenset(json.load(resp["Body"]))
+        self._recent_etag = resp["ETag"]
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            print_exc()
+        finally:
+            self._refreshing = False
+
+    def maybe_refresh(self):
+        now = monotonic()
+        with self._lock:
+            if self._refreshing or now - self._checked < self._refresh_interval:
+                return
+            self._refreshing = True
+            self._checked = now
+
+        Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def might_exist(self, name):
+        current = self._filter
+        if current is None or time() - current.generation > self._max_age:
+            return True
+
+        if name in current or name in self._recent:
+            return True
+
+        now = monotonic()
+        with self._lock:
+            if now - self._rechecked < self._recheck_interval:
+                return False
+            self._rechecked = now
+
+        self.refresh_recent()
+        return name in self._recent
+
+
+NAME_FILTER = None
+if config.getboolean("name_filter", fallback=False):
+    NAME_FILTER = NameFilter(
+        config.getfloat("name_filter_refresh", fallback=60.0),
+        config.getfloat("name_filter_recheck", fallback=1.0),
+        config.getfloat("name_filter_max_age", fallback=900.0),
+    )
+    try:
+        NAME_FILTER.refresh()
+    except Exception:
+        # Without a filter every lookup falls through to DynamoDB
+        print_exc()
+
+
+def _get_manifest_item(repository, image):
     name = f"{repository}:{image}"
 
     # This query validates that the manifest has been indexed
     # If it hasn't, the query will return no items and we'll
     # throw an exception.
-    response = MANIFESTS_TABLE.get_item(Key=dict(name=name))
+    response = dynamodb_client.get_item(
+        TableName=MANIFESTS_TABLE, Key=dict(name=dict(S=name))
+    )
     try:
-        item = response["Item"]
+        item = _unmarshal(response["Item"])
     except KeyError:
         return None
 
-    if "actual" in item:
-        return item["actual"]
+    if "expires" in item:
+        # A deletion tombstone
+        return None
 
-    return name
+    return item
 
 
 def make_response(status, *, headers=None, body=b"", content_type=None):
@@ -57,53 +428,686 @@ def make_response(status, *, headers=None, body=b"", content_type=None):
     )
 
 
+def _remember_large_blobs(body):
+    """Notes the blobs a manifest lists as too big to inline. Their pulls usually
+    follow, and are redirected straight away. A manifest that misstates a size
+    only costs a redirect."""
+
+    if INLINE_BLOB_LIMIT <= 0:
+        return
+
+    try:
+        manifest = json.loads(body)
+        descriptors = [manifest["config"], *manifest["layers"]]
+        large = [d["digest"] for d in descriptors if d["size"] > INLINE_BLOB_LIMIT]
+    except (ValueError, KeyError, TypeError):
+        # An image index, whose children are manifests
+        return
+
+    for digest in large:
+        LARGE_BLOBS.put(digest, True)
+
+
+class Manifest:
+    """What the read path knows about an indexed manifest. Manifests whose bodies
+    aren't stored inline are loaded from S3 on demand."""
+
+    def __init__(self, item):
+        self.digest = item.get("digest")
+        self.media_type = item.get("media_type")
+        self.size = item.get("size")
+        self._body = item["body"].value if "body" in item else None
+        if self._body is not None:
+            _remember_large_blobs(self._body)
+
+        # Child manifests of an image index are stored as blobs
+        self._key = item.get("key") or "manifests/" + item.get("actual", item["name"])
+
+    def load(self):
+        """Returns the body, or None if the stored bytes no longer match the digest
+        that was indexed."""
+
+        if self._body is not None:
+            return self._body
+
+        resp = s3_client().get_object(Bucket=BUCKET_NAME, Key=self._key)
+        body = resp["Body"].read()
+        digest = "sha256:" + sha256(body).hexdigest()
+        if self.digest is None:
+            self.digest = digest
+            self.media_type = json.loads(body)["mediaType"]
+            self.size = len(body)
+        elif digest != self.digest:
+            # The tag has moved on since this alias was indexed
+            return None
+
+        self._body = body
+        _remember_large_blobs(body)
+        return body
+
+    @classmethod
+    def from_body(cls, name, body, media_type):
+        """Describes a manifest that hasn't been indexed yet."""
+
+        return cls(
+            dict(
+                name=name,
+                digest="sha256:" + sha256(body).hexdigest(),
+                media_type=json.loads(body).get("mediaType", media_type),
+                size=len(body),
+                body=Binary(body),
+            )
+        )
+
+
+# Pull-through mode: misses are fetched from this registry, for example
+# https://registry-1.docker.io, and written to the bucket for the indexer.
+UPSTREAM = config.get("upstream")
+UPSTREAM_TIMEOUT = config.getfloat("upstream_timeout", fallback=30.0)
+# Blobs are streamed into S3 in parts of this size; S3's minimum is 5 MiB
+UPLOAD_PART_SIZE = config.getint("upload_part_size", fallback=8 * 1024 * 1024)
+# How long to remember that the upstream lacks a manifest or blob
+UPSTREAM_MISS_TTL = config.getfloat("upstream_miss_ttl", fallback=30.0)
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls: callers asking for a key that is already being
+    worked on wait for that call and share its outcome."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = dict()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class Upstream:
+    """A registry to pull through from, authenticating with anonymous bearer tokens
+    when it asks for them."""
+
+    def __init__(self, url, timeout):
+        self._url = url.rstrip("/")
+        self._timeout = timeout
+        # Tokens are scoped to a repository
+        self._tokens = LRUCache(1024)
+
+    def _authenticate(self, challenge, repository):
+        params = dict(CHALLENGE_PARAM.findall(challenge))
+        query = dict(scope=f"repository:{repository}:pull")
+        if "service" in params:
+            query["service"] = params["service"]
+
+        url = params["realm"] + "?" + urlencode(query)
+        with urlopen(url, timeout=self._timeout) as resp:
+            grant = json.load(resp)
+
+        token = grant.get("token") or grant["access_token"]
+        # Leave some slack for the requests the token is about to be used for
+        self._tokens.put(repository, token, max(grant.get("expires_in", 60) - 10, 1))
+
+    def open(self, repository, path, accept=()):
+        """Opens an upstream URL, or returns None if the upstream doesn't have it."""
+
+        for attempt in range(2):
+            request = Request(f"{self._url}/v2/{repository}/{path}")
+            if accept:
+                request.add_header("Accept", ", ".join(accept))
+            if token := self._tokens.get(repository):
+                # Not forwarded on redirects, which go to pre-signed storage URLs
+                request.add_unredirected_header("Authorization", f"Bearer {token}")
+
+            try:
+                return urlopen(request, timeout=self._timeout)
+            except HTTPError as e:
+                if e.code == 404:
+                    return None
+                challenge = e.headers.get("WWW-Authenticate", "")
+                if e.code != 401 or attempt or not challenge.startswith("Bearer "):
+                    raise
+                self._authenticate(challenge, repository)
+
+    def manifest(self, repository, reference):
+        """Returns a manifest's body and media type, or None."""
+
+        resp = self.open(repository, f"manifests/{reference}", MANIFEST_MEDIA_TYPES)
+        if resp is None:
+            return None
+
+        with resp:
+            return resp.read(), resp.headers.get_content_type()
+
+
+def _blob_size_in_s3(digest):
+    try:
+        resp = s3_client().head_object(Bucket=BUCKET_NAME, Key="blobs/" + digest)
+    except ClientError:
+        # Without s3:ListBucket, missing objects are a 403 rather than a 404
+        return None
+
+    return resp["ContentLength"]
+
+
+def _stream_to_s3(key, stream, digest):
+    """Uploads a stream in parts, completing the upload only if the bytes match
+    `digest`. Returns the size."""
+
+    s3 = s3_client()
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET_NAME, Key=key)["UploadId"]
+    try:
+        h = sha256()
+        size = 0
+        parts = []
+        while True:
+            chunk = stream.read(UPLOAD_PART_SIZE)
+            if not chunk and parts:
+                break
+
+            h.update(chunk)
+            size += len(chunk)
+            part_number = len(parts) + 1
+            resp = s3.upload_part(
+                Bucket=BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=chunk,
+            )
+            parts.append(dict(ETag=resp["ETag"], PartNumber=part_number))
+            if not chunk:
+                # An empty blob still needs one part
+                break
+
+        if "sha256:" + h.hexdigest() != digest:
+            raise ValueError(f"Upstream sent bytes that don't match {digest}")
+
+        s3.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload=dict(Parts=parts),
+        )
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=BUCKET_NAME, Key=key, UploadId=upload_id)
+        raise
+
+    return size
+
+
+class PullThrough:
+    """Fills misses from the upstream registry.
+
+    Manifests are written under manifests/ for the indexer, and served straight
+    away. Blobs are copied into blobs/ when they are first asked for; the indexer
+    then verifies them and resolves the references waiting on them. Tags are
+    pulled once: delete manifests/<name> to pull a tag again.
+
+    Concurrent misses for the same thing are coalesced within a process, and
+    things the upstream lacks are remembered for `upstream_miss_ttl`. Across
+    Lambda containers, a manifest another container has already written but
+    that isn't indexed yet is read from the bucket rather than the upstream.
+    """
+
+    def __init__(self, upstream, miss_ttl):
+        self._upstream = upstream
+        self._flights = SingleFlight()
+        # Keys the upstream lacked; clients retry them, e.g. typos in CI configs
+        self._misses = LRUCache(16384, name="UpstreamMisses")
+        self._miss_ttl = miss_ttl
+
+    def _pull(self, key, fn, miss_key=None):
+        miss_key = miss_key or key
+        if self._misses.get(miss_key):
+            return None
+
+        result = self._flights.do(key, fn)
+        if result is None:
+            self._misses.put(miss_key, True, self._miss_ttl)
+        return result
+
+    def manifest(self, repository, image):
+        """Returns the Manifest for a miss, or None if the upstream lacks it too."""
+
+        key = ("manifest", repository, image)
+        return self._pull(key, lambda: self._pull_manifest(repository, image))
+
+    def blob(self, repository, digest):
+        """Copies a blob into the bucket if it isn't there yet. Returns its size, or
+        None if the upstream lacks it too."""
+
+        key = ("blob", digest)
+        # Upstreams scope blobs to repositories, so their misses are too
+        miss_key = ("blob", repository, digest)
+        return self._pull(key, lambda: self._pull_blob(repository, digest), miss_key)
+
+    @staticmethod
+    def _written(key):
+        try:
+            resp = s3_client().get_object(Bucket=BUCKET_NAME, Key=key)
+        except ClientError as e:
+            # Without s3:ListBucket, missing objects are a 403 rather than a 404
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] not in (403, 404):
+                raise
+            return None
+
+        return resp["Body"].read(), resp["ContentType"]
+
+    def _pull_manifest(self, repository, image):
+        name = f"{repository}:{image}"
+        if fetched := self._written("manifests/" + name):
+            return Manifest.from_body(name, *fetched)
+        # Children of an index that was pulled earlier are already in blobs/
+        if image.startswith("sha256:") and (fetched := self._written("blobs/" + image)):
+            return Manifest.from_body(name, *fetched)
+
+        fetched = self._upstream.manifest(repository, image)
+        if fetched is None:
+            return None
+
+        body, media_type = fetched
+        manifest = Manifest.from_body(name, body, media_type)
+        if image.startswith("sha256:") and manifest.digest != image:
+            raise ValueError(f"Upstream sent the wrong manifest for {name}")
+
+        # The indexer reads the children of an image index from blobs/
+        for child in json.loads(body).get("manifests", []):
+            self._pull_child(repository, child["digest"])
+
+        s3_client().put_object(
+            Bucket=BUCKET_NAME,
+            Key="manifests/" + name,
+            Body=body,
+            ContentType=manifest.media_type,
+        )
+        return manifest
+
+    def _pull_child(self, repository, digest):
+        if _blob_size_in_s3(digest) is not None:
+            return
+
+        fetched = self._upstream.manifest(repository, digest)
+        if fetched is None:
+            return
+
+        body, media_type = fetched
+        if "sha256:" + sha256(body).hexdigest() != digest:
+            raise ValueError(f"Upstream sent the wrong manifest for {digest}")
+
+        s3_client().put_object(
+            Bucket=BUCKET_NAME, Key="blobs/" + digest, Body=body, ContentType=media_type
+        )
+
+    def _pull_blob(self, repository, digest):
+        if (size := _blob_size_in_s3(digest)) is not None:
+            return size
+
+        if not digest.startswith("sha256:"):
+            return None
+
+        resp = self._upstream.open(repository, f"blobs/{digest}")
+        if resp is None:
+            return None
+
+        with resp:
+            return _stream_to_s3("blobs/" + digest, resp, digest)
+
+
+PULL_THROUGH = None
+if UPSTREAM:
+    PULL_THROUGH = PullThrough(Upstream(UPSTREAM, UPSTREAM_TIMEOUT), UPSTREAM_MISS_TTL)
+
+# Token authentication: with a JWKS configured, every request needs a bearer
+# token from the token server at `auth_realm`, signed by one of its keys. The
+# keys are loaded once per container, and verified tokens are cached until they
+# expire, so most requests only pay for a dictionary lookup.
+AUTH_JWKS = config.get("auth_jwks")
+AUTH_REALM = config.get("auth_realm")
+AUTH_SERVICE = config.get("auth_service")
+AUTH_ISSUER = config.get("auth_issuer")
+KEYS = None
+if AUTH_JWKS:
+    # Relative to the task root, where it is packaged next to config.ini
+    with open(join(environ["LAMBDA_TASK_ROOT"], AUTH_JWKS)) as f:
+        KEYS = KeySet.loads(f.read())
+TOKENS = LRUCache(config.getint("token_cache_size", fallback=4096), name="Tokens")
+
+
+def _grants(token):
+    """Returns what a token grants, verifying it on first sight."""
+
+    grants = TOKENS.get(token)
+    if grants is None:
+        with METRICS.timed("VerifyToken"):
+            claims = KEYS.verify(token)
+        now = time()
+        validate(claims, AUTH_ISSUER, AUTH_SERVICE, now)
+        grants = Grants(claims.get("access"))
+        TOKENS.put(token, grants, claims["exp"] - now)
+
+    return grants
+
+
 class App:
-    def __init__(self, method, path):
+    def __init__(self, method, path, headers=None, query=None):
         self._method = method
         self._path = path
+        # Function URLs deliver header names in lowercase
+        self._headers = headers or dict()
+        self._query = query or dict()
 
-    @staticmethod
-    def route_manifests(repository, image):
-        name = _get_actual_manifest(repository, image)
-        if name is None:
+    def _if_none_match(self, digest):
+        header = self._headers.get("if-none-match")
+        if header is None:
+            return False
+
+        tags = {tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")}
+        return "*" in tags or digest in tags
+
+    def route_manifests(self, repository, image):
+        key = f"{repository}:{image}"
+        manifest = MANIFEST_CACHE.get(key)
+        if manifest is None:
+            # Only tags are in the filter, and only misses are pulled through
+            tag = not image.startswith("sha256:")
+            if NAME_FILTER is not None and PULL_THROUGH is None and tag:
+                NAME_FILTER.maybe_refresh()
+                if not NAME_FILTER.might_exist(key):
+                    return make_response(404, body="Unknown image")
+
+            item = _get_manifest_item(repository, image)
+            if item is not None:
+                manifest = Manifest(item)
+            elif PULL_THROUGH is not None:
+                manifest = PULL_THROUGH.manifest(repository, image)
+            else:
+                manifest = None
+
+            if manifest is None:
+                return make_response(404, body="Unknown image")
+
+            # Digest-addressed manifests never change
+            ttl = None if image == manifest.digest else TAG_CACHE_TTL
+            MANIFEST_CACHE.put(key, manifest, ttl)
+
+        if manifest.digest is None:
+            # Indexed before digests were recorded; we have to read the body
+            manifest.load()
+
+        headers = {
+            "Docker-Content-Digest": manifest.digest,
+            "ETag": f'"{manifest.digest}"',
+        }
+        if image == manifest.digest:
+            # The content behind a digest can never change, so let CDNs and
+            # clients hold on to it.
+            headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+
+        if self._if_none_match(manifest.digest):
+            return make_response(304, headers=headers)
+
+        if self._method == "HEAD":
+            headers["Content-Length"] = str(manifest.size)
+            return make_response(200, headers=headers, content_type=manifest.media_type)
+
+        body = manifest.load()
+        if body is None:
             return make_response(404, body="Unknown image")
 
-        body = s3_client.get_object(
-            Bucket=BUCKET_NAME,
-            Key=f"manifests/{name}",
-        )["Body"].read()
-        media_type = json.loads(body)["mediaType"]
-        return make_response(200, body=body, content_type=media_type)
+        return make_response(
+            200, headers=headers, body=body, content_type=manifest.media_type
+        )
+
+    @staticmethod
+    def _blob_size(digest):
+        size = BLOB_SIZES.get(digest)
+        if size is None:
+            resp = dynamodb_client.get_item(
+                TableName=BLOBS_TABLE,
+                Key=dict(digest=dict(S=digest)),
+                ProjectionExpression="#size",
+                ExpressionAttributeNames={"#size": "size"},
+            )
+            size = resp.get("Item", {}).get("size", {}).get("N")
+            if size is None:
+                # Not uploaded yet, or indexed before sizes were recorded
+                BLOB_SIZES.put(digest, MISSING_SIZE, BLOB_MISS_TTL)
+                return None
+
+            # Blobs are content-addressed, so their sizes never change
+            size = int(size)
+            BLOB_SIZES.put(digest, size)
+
+        return None if size == MISSING_SIZE else size
+
+    def _route_small_blob(self, digest):
+        if LARGE_BLOBS.get(digest):
+            return None
+
+        size = self._blob_size(digest)
+        if size is None or size > INLINE_BLOB_LIMIT:
+            return None
+
+        headers = {
+            "Docker-Content-Digest": digest,
+            "ETag": f'"{digest}"',
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        }
+        content_type = "application/octet-stream"
+        if self._if_none_match(digest):
+            return make_response(304, headers=headers)
+
+        if self._method == "HEAD":
+            headers["Content-Length"] = str(size)
+            return make_response(200, headers=headers, content_type=content_type)
+
+        body = BLOB_CACHE.get(digest)
+        if body is None:
+            resp = s3_client().get_object(Bucket=BUCKET_NAME, Key="blobs/" + digest)
+            body = resp["Body"].read()
+            BLOB_CACHE.put(digest, body)
+
+        return make_response(200, headers=headers, body=body, content_type=content_type)
 
     def route_blobs(self, repository, digest):
-        path = "blobs/" + digest
+        if PULL_THROUGH is not None and self._blob_size(digest) is None:
+            size = PULL_THROUGH.blob(repository, digest)
+            if size is None:
+                return make_response(404, body="Unknown blob")
+            BLOB_SIZES.put(digest, size)
+
+        if INLINE_BLOB_LIMIT > 0:
+            response = self._route_small_blob(digest)
+            if response is not None:
+                return response
+
+        url, remaining = presigned_blob_url(self._method, digest, time())
+        headers = {
+            "Location": url,
+            # Everyone asking within this window is sent the same URL
+            "Cache-Control": f"public, max-age={remaining}",
+        }
+        return make_response(302, body="Redirect", headers=headers)
+
+    def _page_size(self):
+        try:
+            n = int(self._query.get("n", DEFAULT_PAGE_SIZE))
+        except ValueError:
+            n = DEFAULT_PAGE_SIZE
+
+        return max(1, min(n, MAX_PAGE_SIZE))
+
+    def _page(self, table, n, start_key, **kwargs):
+        """Queries a single page, resuming after the item keyed by `start_key`."""
+
+        kwargs["Limit"] = n
+        if self._query.get("last"):
+            kwargs["ExclusiveStartKey"] = {k: dict(S=v) for k, v in start_key.items()}
+        resp = dynamodb_client.query(TableName=table, **kwargs)
+        resp["Items"] = [_unmarshal(item) for item in resp["Items"]]
+        return resp
+
+    @staticmethod
+    def _paginated_response(path, body, values, n, resp):
+        headers = dict()
+        if "LastEvaluatedKey" in resp and values:
+            query = urlencode(dict(n=n, last=values[-1]))
+            headers["Link"] = f'<{path}?{query}>; rel="next"'
+
+        return make_response(200, headers=headers, body=body)
+
+    def route_tags(self, repository, suffix):
+        if suffix != "list":
+            return make_response(404, body="Not Found")
+
+        n = self._page_size()
+        last = self._query.get("last")
+        resp = self._page(
+            MANIFESTS_TABLE,
+            n,
+            dict(repository=repository, tag=last, name=f"{repository}:{last}"),
+            IndexName=TAGS_INDEX,
+            KeyConditionExpression="repository = :repository",
+            ExpressionAttributeValues={":repository": dict(S=repository)},
+        )
+        tags = [item["tag"] for item in resp["Items"]]
+        if not tags and not last:
+            return make_response(404, body="Unknown repository")
+
+        return self._paginated_response(
+            f"/v2/{repository}/tags/list",
+            dict(name=repository, tags=tags),
+            tags,
+            n,
+            resp,
+        )
 
-        url = s3_client.generate_presigned_url(
-            f"{self._method.lower()}_object",
-            Params=dict(Bucket=BUCKET_NAME, Key=path),
-            ExpiresIn=900,
+    def route_catalog(self):
+        n = self._page_size()
+        resp = self._page(
+            REPOSITORIES_TABLE,
+            n,
+            dict(catalog=CATALOG, repository=self._query.get("last")),
+            # CATALOG is a reserved word
+            KeyConditionExpression="#catalog = :catalog",
+            ExpressionAttributeNames={"#catalog": "catalog"},
+            ExpressionAttributeValues={":catalog": dict(S=CATALOG)},
+        )
+        repositories = [item["repository"] for item in resp["Items"]]
+        return self._paginated_response(
+            "/v2/_catalog", dict(repositories=repositories), repositories, n, resp
         )
-        return make_response(302, body="Redirect", headers={"Location": url})
+
+    def _challenge(self, scope, error=None):
+        params = dict(realm=AUTH_REALM, service=AUTH_SERVICE, scope=scope, error=error)
+        challenge = ",".join(f'{k}="{v}"' for k, v in params.items() if v)
+        headers = {"WWW-Authenticate": "Bearer " + challenge}
+        return make_response(401, headers=headers, body="Unauthorized")
+
+    def _authorize(self, type=None, name=None, action=None):
+        """Returns a 401 response unless the request's token grants `action` on
+        the resource. Without a resource, any valid token will do."""
+
+        if KEYS is None:
+            return None
+
+        scope = None if type is None else f"{type}:{name}:{action}"
+        scheme, _, token = self._headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return self._challenge(scope)
+
+        try:
+            grants = _grants(token.strip())
+        except InvalidToken:
+            return self._challenge(scope, "invalid_token")
+
+        if type is not None and not grants.allows(type, name, action):
+            return self._challenge(scope, "insufficient_scope")
+
+        return None
 
     def route(self):
         if self._method not in ("GET", "HEAD"):
-            return make_response(405, "Method Not Allowed")
+            return make_response(405, body="Method Not Allowed")
+
+        if self._path in ("/v2", "/v2/"):
+            # Clients probe this to find out how to authenticate
+            headers = {"Docker-Distribution-API-Version": "registry/2.0"}
+            return self._authorize() or make_response(200, headers=headers, body={})
+
+        if self._path == "/v2/_catalog":
+            return self._authorize("registry", "catalog", "*") or self.route_catalog()
 
         m = MATCHER.match(self._path[1:])
-        if not m:
+        if not m or len(m[1]) > MAX_REPOSITORY_LENGTH:
             return make_response(404, body="Not Found")
 
         repository, action, suffix = m.groups()
+        if action != "tags" and not (
+            DIGEST.fullmatch(suffix) or action == "manifests" and TAG.fullmatch(suffix)
+        ):
+            return make_response(404, body="Not Found")
+
+        if response := self._authorize("repository", repository, "pull"):
+            return response
+
         route = getattr(self, "route_" + action)
         return route(repository, suffix)
 
 
-def lambda_handler(event, context):
+def handle(event):
+    """Routes a function URL event. Metrics are left for the caller to flush."""
+
     try:
-        return App(
-            event["requestContext"]["http"]["method"],
-            event["requestContext"]["http"]["path"],
-        ).route()
+        with profiled(PROFILE_SAMPLE_RATE):
+            return App(
+                event["requestContext"]["http"]["method"],
+                event["requestContext"]["http"]["path"],
+                event.get("headers"),
+                dict(parse_qsl(event.get("rawQueryString", ""))),
+            ).route()
     except Exception:
         body = format_exc() if config["debug"] == "true" else "Internal Server Error"
         return make_response(500, body=body)
+
+
+def lambda_handler(event, context):
+    try:
+        return handle(event)
+    finally:
+        METRICS.flush()
@@ -0,0 +1,149 @@
+"""Verifies the bearer tokens of Docker's token authentication scheme.
+
+Clients fetch a token from a token server and send it with every request. The
+token is a JWT signed with RS256 by one of the keys in a JWKS, whose claims
+list the actions it grants on each resource:
+
+    {"iss": ..., "aud": <service>, "exp": ..., "access": [
+        {"type": "repository", "name": "team/app", "actions": ["pull"]}]}
+
+Verification is done here in plain Python so that the read lambda needs no
+native dependencies: an RSA public key operation is a single pow().
+"""
+import hmac
+import json
+from base64 import urlsafe_b64decode
+from hashlib import sha256
+
+# The DER encoding of a SHA-256 DigestInfo, less the digest (RFC 8017, 9.2)
+SHA256_DIGEST_INFO = bytes.fromhex("3031300d060960864801650304020105000420")
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64decode(segment):
+    try:
+        return urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+    except ValueError as e:
+        raise InvalidToken("Malformed token") from e
+
+
+def _int(segment):
+    return int.from_bytes(_b64decode(segment), "big")
+
+
+class RSAKey:
+    def __init__(self, n, e):
+        self._n = n
+        self._e = e
+        self._size = (n.bit_length() + 7) // 8
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        return cls(_int(jwk["n"]), _int(jwk["e"]))
+
+    def verify(self, message, signature):
+        """Checks an RSASSA-PKCS1-v1_5 signature over SHA-256."""
+
+        if len(signature) != self._size:
+            return False
+
+        s = int.from_bytes(signature, "big")
+        if s >= self._n:
+            return False
+
+        encoded = pow(s, self._e, self._n).to_bytes(self._size, "big")
+        t = SHA256_DIGEST_INFO + sha256(message).digest()
+        expected = b"\x00\x01" + b"\xff" * (self._size - len(t) - 3) + b"\x00" + t
+        return hmac.compare_digest(encoded, expected)
+
+
+class KeySet:
+    """The token server's signing keys, by key ID."""
+
+    def __init__(self, keys):
+        self._keys = keys
+
+    @classmethod
+    def loads(cls, text):
+        keys = dict()
+        for jwk in json.loads(text)["keys"]:
+            if jwk.get("kty") != "RSA" or jwk.get("alg", "RS256") != "RS256":
+                continue
+            if jwk.get("use", "sig") != "sig":
+                continue
+            keys[jwk.get("kid")] = RSAKey.from_jwk(jwk)
+
+        if not keys:
+            raise ValueError("The JWKS has no RS256 signing keys")
+        return cls(keys)
+
+    def verify(self, token):
+        """Returns the claims of a token with a valid signature."""
+
+        try:
+            header, payload, signature = token.split(".")
+        except ValueError as e:
+            raise InvalidToken("Malformed token") from e
+
+        try:
+            headers = json.loads(_b64decode(header))
+            claims = json.loads(_b64decode(payload))
+        except ValueError as e:
+            raise InvalidToken("Malformed token") from e
+
+        if not isinstance(headers, dict) or not isinstance(claims, dict):
+            raise InvalidToken("Malformed token")
+        if headers.get("alg") != "RS256":
+            raise InvalidToken("Tokens must be signed with RS256")
+
+        kid = headers.get("kid")
+        if kid is None and len(self._keys) == 1:
+            key = next(iter(self._keys.values()))
+        else:
+            key = self._keys.get(kid)
+        if key is None:
+            raise InvalidToken("Signed by an unknown key")
+
+        if not key.verify(f"{header}.{payload}".encode(), _b64decode(signature)):
+            raise InvalidToken("Bad signature")
+
+        return claims
+
+
+def validate(claims, issuer, audience, now, leeway=30):
+    """Checks a verified token's claims; `issuer` and `audience` may be None."""
+
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp + leeway <= now:
+        raise InvalidToken("Token expired")
+    nbf = claims.get("nbf")
+    if isinstance(nbf, (int, float)) and nbf - leeway > now:
+        raise InvalidToken("Token not valid yet")
+
+    if issuer is not None and claims.get("iss") != issuer:
+        raise InvalidToken("Wrong issuer")
+
+    aud = claims.get("aud")
+    audiences = aud if isinstance(aud, list) else [aud]
+    if audience is not None and audience not in audiences:
+        raise InvalidToken("Wrong audience")
+
+
+class Grants:
+    """The actions a token grants, by (type, name), for lookups per request."""
+
+    def __init__(self, access):
+        self._actions = dict()
+        for entry in access or []:
+            try:
+                key = (entry["type"], entry["name"])
+                self._actions.setdefault(key, set()).update(entry.get("actions", []))
+            except (KeyError, TypeError) as e:
+                raise InvalidToken("Malformed access claim") from e
+
+    def allows(self, type, name, action):
+        actions = self._actions.get((type, name), ())
+        return action in actions or "*" in actions
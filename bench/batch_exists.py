@@ -0,0 +1,103 @@
+"""Benchmarks Blob.batch_exists on layer-heavy manifests.
+
+The concurrent existence engine is compared against a serial loop of one
+BatchGetItem per 100 digests. Both rely on blob uploads having been indexed and
+make no S3 calls, so both must report exactly the indexed fraction of the
+uploaded blobs.
+
+    python bench/batch_exists.py --layers 10 50 100 200 --latency 0.01
+"""
+import argparse
+from hashlib import sha256
+from time import perf_counter
+
+import boto3
+from standins import BUCKET
+from standins import StandIns
+
+
+def serial_batch_exists(digests):
+    dynamodb = boto3.resource("dynamodb")
+
+    exists = set()
+    unique = sorted(set(digests))
+    for i in range(0, len(unique), 100):
+        resp = dynamodb.batch_get_item(
+            RequestItems=dict(
+                blobs=dict(
+                    Keys=[dict(digest=d) for d in unique[i : i + 100]],
+                    ProjectionExpression="digest",
+                )
+            )
+        )
+        exists.update(row["digest"] for row in resp["Responses"]["blobs"])
+
+    return exists
+
+
+def make_digests(n):
+    return ["sha256:" + sha256(b"layer %d" % i).hexdigest() for i in range(n)]
+
+
+def reset(digests, indexed_fraction):
+    """Uploads every blob, but only indexes a fraction of them in DynamoDB."""
+
+    s3 = boto3.client("s3")
+    table = boto3.resource("dynamodb").Table("blobs")
+    cutoff = int(len(digests) * indexed_fraction)
+
+    with table.batch_writer() as batch:
+        for digest in digests:
+            batch.delete_item(Key=dict(digest=digest))
+    with table.batch_writer() as batch:
+        for digest in digests[:cutoff]:
+            batch.put_item(Item=dict(digest=digest))
+
+    for digest in digests:
+        s3.put_object(Bucket=BUCKET, Key="blobs/" + digest, Body=b"")
+
+
+def measure(standins, fn, digests, args):
+    best = None
+    for _ in range(args.repeat):
+        reset(digests, args.indexed)
+        standins.reset_calls()
+        standins.latency = args.latency
+        start = perf_counter()
+        found = fn(digests)
+        elapsed = perf_counter() - start
+        standins.latency = 0
+        indexed = set(digests[: int(len(digests) * args.indexed)])
+        assert found == indexed, "existence check is wrong"
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, standins.total_calls()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--layers", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--indexed", type=float, default=0.9)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with StandIns(latency=0) as standins:
+        lambda_ = standins.load("lambda")
+
+        print(f"{'layers':>6} {'serial':>10} {'calls':>6} {'engine':>10} {'calls':>6}")
+        for n in args.layers:
+            digests = make_digests(n)
+            serial, serial_calls = measure(standins, serial_batch_exists, digests, args)
+            engine, engine_calls = measure(
+                standins, lambda_.Blob.batch_exists, digests, args
+            )
+            print(
+                f"{n:>6} {serial * 1000:>8.1f}ms {serial_calls:>6} "
+                f"{engine * 1000:>8.1f}ms {engine_calls:>6}  "
+                f"({serial / engine:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""A fake upstream registry, serving a directory laid out like testdata.sh output.
+
+Manifests are read from manifests/<repository>:<reference> and blobs from
+blobs/<digest>; child manifests of an index are blobs too. Like Docker Hub, it
+can demand anonymous bearer tokens and redirect blob downloads to "storage"
+that rejects requests carrying credentials.
+
+    ./testdata.sh && python bench/fake_upstream.py . --port 5001 --auth
+
+Point the read path at it with `upstream = http://127.0.0.1:5001`.
+"""
+import argparse
+import json
+import re
+from collections import Counter
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock
+from threading import Thread
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+ROUTE = re.compile("^/v2/(.+)/(manifests|blobs)/([^/]+)$")
+TOKEN = "fake-token"
+CHUNK_SIZE = 1024 * 1024
+
+
+class FakeUpstream:
+    """Context manager that serves `root` on a local port. Counts the requests
+    it serves by kind in `requests`."""
+
+    def __init__(self, root, *, auth=False, redirect=False, port=0):
+        self.root = Path(root)
+        self.auth = auth
+        self.redirect = redirect
+        self.requests = Counter()
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.upstream = self
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def find_manifest(self, repository, reference):
+        path = self.root / "manifests" / f"{repository}:{reference}"
+        if path.is_file():
+            return path.read_bytes()
+
+        if not reference.startswith("sha256:"):
+            return None
+
+        # By digest: a child manifest, or one of the tagged manifests
+        path = self.root / "blobs" / reference
+        if path.is_file():
+            return path.read_bytes()
+        for path in (self.root / "manifests").glob(f"{repository}:*"):
+            body = path.read_bytes()
+            if "sha256:" + sha256(body).hexdigest() == reference:
+                return body
+
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def upstream(self):
+        return self.server.upstream
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _authorized(self, repository):
+        if not self.upstream.auth:
+            return True
+        if self.headers.get("Authorization") == f"Bearer {TOKEN}":
+            return True
+
+        self.upstream.count("unauthorized")
+        realm = f"{self.upstream.url}/token"
+        challenge = (
+            f'Bearer realm="{realm}",service="fake-upstream",'
+            f'scope="repository:{repository}:pull"'
+        )
+        self._send(401, b"{}", [("WWW-Authenticate", challenge)])
+        return False
+
+    def _token(self):
+        self.upstream.count("token")
+        query = parse_qs(urlsplit(self.path).query)
+        assert query.get("service") == ["fake-upstream"], query
+        body = json.dumps(dict(token=TOKEN, expires_in=300)).encode()
+        self._send(200, body, [("Content-Type", "application/json")])
+
+    def _stream(self, path):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                self.wfile.write(chunk)
+
+    def _storage(self, digest):
+        # Pre-signed storage URLs reject requests that carry other credentials
+        if "Authorization" in self.headers:
+            self.upstream.count("storage-with-credentials")
+            return self._send(400, b"Unexpected Authorization header")
+
+        path = self.upstream.root / "blobs" / digest
+        if not path.is_file():
+            return self._send(404)
+        self._stream(path)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/token":
+            return self._token()
+        if url.path == "/v2/":
+            return self._send(200, b"{}")
+        if url.path.startswith("/storage/"):
+            return self._storage(url.path[len("/storage/") :])
+
+        m = ROUTE.match(url.path)
+        if not m:
+            return self._send(404)
+
+        repository, kind, reference = m.groups()
+        if not self._authorized(repository):
+            return
+        self.upstream.count(kind)
+
+        if kind == "manifests":
+            body = self.upstream.find_manifest(repository, reference)
+            if body is None:
+                return self._send(404, b"{}")
+
+            media_type = json.loads(body).get("mediaType", "application/json")
+            headers = [
+                ("Content-Type", media_type),
+                ("Docker-Content-Digest", "sha256:" + sha256(body).hexdigest()),
+            ]
+            return self._send(200, body, headers)
+
+        path = self.upstream.root / "blobs" / reference
+        if not path.is_file():
+            return self._send(404, b"{}")
+        if self.upstream.redirect:
+            return self._send(307, headers=[("Location", f"/storage/{reference}")])
+        self._stream(path)
+
+    do_HEAD = do_GET
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--auth", action="store_true")
+    parser.add_argument("--redirect", action="store_true")
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(
+        args.root, auth=args.auth, redirect=args.redirect, port=args.port
+    )
+    print(f"Serving {args.root} at {upstream.url}")
+    upstream.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Load-tests server.py over HTTP against the stand-ins.
+
+Many clients, each on its own keep-alive connection, replay the read path
+bench's request mix against a Server running on its own event loop. Every
+response is checked, and so are the metrics: they must be logged once per
+--metrics-interval rather than once per request, and between them account for
+every AWS call the server made.
+
+    python bench/http_server.py --clients 64 --requests 5000 --latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from http.client import HTTPConnection
+from io import StringIO
+from math import ceil
+from random import Random
+from threading import Thread
+from time import perf_counter
+
+from read_path import EXPECTED_STATUS
+from read_path import MIX
+from read_path import percentile
+from read_path import Registry
+from standins import ROOT
+from standins import StandIns
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Running:
+    """Context manager that runs a Server on a thread of its own."""
+
+    def __init__(self, server, port):
+        self._server = server
+        self._port = port
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run)
+
+    def _run(self):
+        self._task = self._loop.create_task(self._server.serve("127.0.0.1", self._port))
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+
+    def __enter__(self):
+        self._thread.start()
+        # Wait for the server to accept connections
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self._port)).close()
+                return self
+            except ConnectionRefusedError:
+                pass
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join()
+        self._loop.close()
+
+
+def client(port, requests):
+    """Sends (kind, method, path) requests in order on one connection."""
+
+    connection = HTTPConnection("127.0.0.1", port)
+    latencies = defaultdict(list)
+    for kind, method, path in requests:
+        start = perf_counter()
+        connection.request(method, path)
+        response = connection.getresponse()
+        response.read()
+        latencies[kind].append(perf_counter() - start)
+        assert response.status == EXPECTED_STATUS[kind], (kind, path, response.status)
+    connection.close()
+    return latencies
+
+
+def replay(port, registry, args):
+    rng = Random(args.seed)
+    kinds = rng.choices(list(MIX), weights=list(MIX.values()), k=args.requests)
+    requests = [(kind, *registry.request(kind, rng)) for kind in kinds]
+    shares = [requests[i :: args.clients] for i in range(args.clients)]
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(client, [port] * args.clients, shares))
+    elapsed = perf_counter() - start
+
+    latencies = defaultdict(list)
+    for result in results:
+        for kind, values in result.items():
+            latencies[kind].extend(values)
+    return latencies, elapsed
+
+
+def check_metrics(lines, standins, elapsed, interval):
+    """Returns a description of every problem with the logged metrics."""
+
+    records = [json.loads(line) for line in lines if line.startswith("{")]
+    problems = []
+    # One per interval, plus the final flush
+    most = ceil(elapsed / interval) + 1
+    if len(records) > most:
+        problems.append(f"{len(records)} metrics lines, expected at most {most}")
+
+    logged = sum(r.get("AWSCalls", 0) for r in records)
+    if logged != standins.total_calls():
+        problems.append(f"{logged} AWS calls logged, {standins.total_calls()} made")
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--repositories", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--metrics-interval", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(ROOT))
+    from server import Server
+
+    with StandIns(latency=0) as standins:
+        registry = Registry(args.repositories, args.tags, args.layers)
+        app = standins.load("app", max_pool_connections=args.workers)
+        standins.latency = args.latency
+        standins.reset_calls()
+
+        port = _free_port()
+        server = Server(app, args.workers, args.metrics_interval)
+        out = StringIO()
+        with redirect_stdout(out):
+            with Running(server, port):
+                latencies, elapsed = replay(port, registry, args)
+
+    print(f"{'request':>20} {'p50':>9} {'p99':>9}")
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        print(
+            f"{kind:>20} {percentile(values, 50) * 1000:>7.2f}ms "
+            f"{percentile(values, 99) * 1000:>7.2f}ms"
+        )
+    print(f"{args.requests / elapsed:.0f} requests/s from {args.clients} clients")
+
+    problems = check_metrics(
+        out.getvalue().splitlines(), standins, elapsed, args.metrics_interval
+    )
+    if problems:
+        print("\n".join(problems))
+        sys.exit(f"{len(problems)} problems with the logged metrics")
+
+
+if __name__ == "__main__":
+    main()
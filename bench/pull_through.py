@@ -0,0 +1,199 @@
+"""Benchmarks pull-through: cold pulls from a fake upstream, then warm ones.
+
+An image index with a few platform images is written to a temporary directory
+and served by bench/fake_upstream.py, which demands bearer tokens and redirects
+blob downloads to storage. Many clients then pull the same tag at once, as a
+fleet of build hosts does after a release, each also asking for a tag and a
+blob the upstream lacks. Every miss must reach the upstream exactly once, and
+every copied blob must match its digest.
+
+    python bench/pull_through.py --clients 32 --platforms 2 --layer-mb 16
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+from pathlib import Path
+from tempfile import mkdtemp
+from time import perf_counter
+
+import boto3
+from fake_upstream import FakeUpstream
+from standins import BUCKET
+from standins import StandIns
+
+INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+REPOSITORY = "library/base"
+TAG = "latest"
+MISSING_TAG = "no-such-tag"
+MISSING_BLOB = "sha256:" + sha256(b"no such blob").hexdigest()
+
+
+def _digest(data):
+    return "sha256:" + sha256(data).hexdigest()
+
+
+class Image:
+    """Writes an image index in the layout testdata.sh produces."""
+
+    def __init__(self, root, platforms, layers, layer_size):
+        self.root = Path(root)
+        (self.root / "manifests").mkdir(parents=True)
+        (self.root / "blobs").mkdir()
+
+        self.children = []
+        self.blobs = dict()
+        for p in range(platforms):
+            config = self._blob(json.dumps(dict(platform=p)).encode())
+            layer_digests = [self._blob(os.urandom(layer_size)) for _ in range(layers)]
+            body = json.dumps(
+                dict(
+                    schemaVersion=2,
+                    mediaType=MEDIA_TYPE,
+                    config=dict(
+                        mediaType=CONFIG_MEDIA_TYPE,
+                        size=self.blobs[config],
+                        digest=config,
+                    ),
+                    layers=[
+                        dict(
+                            mediaType=LAYER_MEDIA_TYPE,
+                            size=self.blobs[d],
+                            digest=d,
+                        )
+                        for d in layer_digests
+                    ],
+                )
+            ).encode()
+            # Child manifests live with the blobs, as they do in the bucket
+            (self.root / "blobs" / _digest(body)).write_bytes(body)
+            self.children.append(
+                dict(mediaType=MEDIA_TYPE, size=len(body), digest=_digest(body))
+            )
+
+        self.index = json.dumps(
+            dict(schemaVersion=2, mediaType=INDEX_MEDIA_TYPE, manifests=self.children)
+        ).encode()
+        path = self.root / "manifests" / f"{REPOSITORY}:{TAG}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(self.index)
+
+    def _blob(self, data):
+        digest = _digest(data)
+        (self.root / "blobs" / digest).write_bytes(data)
+        self.blobs[digest] = len(data)
+        return digest
+
+
+def request(app, path):
+    event = dict(requestContext=dict(http=dict(method="GET", path=path)), headers={})
+    return app.lambda_handler(event, None)
+
+
+def pull(app, image, pool):
+    """Pulls the index, then every child manifest, then every blob concurrently,
+    like a client pulling all platforms. Returns the responses, and those to the
+    requests for things the upstream lacks."""
+
+    responses = [request(app, f"/v2/{REPOSITORY}/manifests/{TAG}")]
+    paths = [
+        f"/v2/{REPOSITORY}/manifests/{child['digest']}" for child in image.children
+    ]
+    paths += [f"/v2/{REPOSITORY}/blobs/{digest}" for digest in image.blobs]
+    responses += pool.map(lambda path: request(app, path), paths)
+
+    missing = [
+        request(app, f"/v2/{REPOSITORY}/manifests/{MISSING_TAG}"),
+        request(app, f"/v2/{REPOSITORY}/blobs/{MISSING_BLOB}"),
+    ]
+    return responses, missing
+
+
+def clients(app, image, n):
+    """Runs `n` concurrent pulls. Returns the seconds each took."""
+
+    def timed_pull(_):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            start = perf_counter()
+            responses, missing = pull(app, image, pool)
+            elapsed = perf_counter() - start
+
+        for response in responses:
+            assert response["statusCode"] in (200, 302), response
+        for response in missing:
+            assert response["statusCode"] == 404, response
+        return elapsed
+
+    # Keep the per-invocation metrics lines out of the report
+    with redirect_stdout(StringIO()):
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            return sorted(pool.map(timed_pull, range(n)))
+
+
+def check(image, upstream):
+    """Returns a description of every miss that wasn't filled exactly once."""
+
+    problems = []
+    # Plus one request for each missing thing, whose miss is remembered
+    want = dict(manifests=2 + len(image.children), blobs=1 + len(image.blobs))
+    for kind, count in want.items():
+        if upstream.requests[kind] != count:
+            problems.append(
+                f"{upstream.requests[kind]} upstream {kind} requests, expected {count}"
+            )
+    if upstream.requests["storage-with-credentials"]:
+        problems.append("credentials were sent to the storage redirect")
+
+    s3 = boto3.client("s3")
+    resp = s3.get_object(Bucket=BUCKET, Key=f"manifests/{REPOSITORY}:{TAG}")
+    if resp["Body"].read() != image.index:
+        problems.append("manifests/ holds a different index")
+    for digest in [c["digest"] for c in image.children] + list(image.blobs):
+        body = s3.get_object(Bucket=BUCKET, Key="blobs/" + digest)["Body"].read()
+        if _digest(body) != digest:
+            problems.append(f"blobs/{digest} doesn't match its digest")
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--platforms", type=int, default=2)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--layer-mb", type=float, default=8.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    root = mkdtemp(prefix="registry-upstream-")
+    image = Image(root, args.platforms, args.layers, int(args.layer_mb * (1 << 20)))
+    megabytes = sum(image.blobs.values()) / (1 << 20)
+
+    with FakeUpstream(root, auth=True, redirect=True) as upstream:
+        with StandIns(latency=args.latency) as standins:
+            app = standins.load("app", upstream=upstream.url, inline_blob_limit=0)
+            cold = clients(app, image, args.clients)
+            warm = clients(app, image, args.clients)
+            problems = check(image, upstream)
+
+    print(f"{args.clients} clients pulling {megabytes:.1f} MB each")
+    print(f"{'pull':>6} {'median':>9} {'slowest':>9}")
+    for name, times in (("cold", cold), ("warm", warm)):
+        print(f"{name:>6} {times[len(times) // 2]:>8.2f}s {times[-1]:>8.2f}s")
+    print(f"Copied from upstream at {megabytes / cold[-1]:.1f} MB/s")
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(f"{len(problems)} problems")
+
+
+if __name__ == "__main__":
+    main()
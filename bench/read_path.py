@@ -0,0 +1,276 @@
+"""Benchmarks the read path by replaying a mix of registry requests.
+
+Requests are routed by a freshly loaded app.py, so its caches start cold, and
+are drawn from a fixed mix: HEAD and GET of manifests by tag and by digest,
+blob pulls that are served inline or redirected to S3, and pulls of things
+that don't exist.
+
+    python bench/read_path.py --requests 2000 --latency 0.005
+    python bench/read_path.py --save              # record a baseline
+    python bench/read_path.py --compare           # fail on regressions
+
+Baselines of the AWS calls each kind of request makes are stored per latency
+in bench/baselines/read_path.json. A compare run fails if any kind of request
+makes more calls than its baseline by more than --tolerance: tag cache expiry
+depends on wall-clock time, so call counts vary a little between runs.
+Latencies against the stand-ins depend on the machine and its load, so they
+are reported but not compared.
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+from pathlib import Path
+from random import Random
+from time import perf_counter
+
+import boto3
+from standins import BUCKET
+from standins import StandIns
+
+BASELINES = Path(__file__).resolve().parent / "baselines" / "read_path.json"
+
+MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+# Relative weights of each kind of request in the replayed mix
+MIX = {
+    "manifest-get-tag": 20,
+    "manifest-head-tag": 20,
+    "manifest-get-digest": 15,
+    "blob-inline": 10,
+    "blob-redirect": 25,
+    "manifest-404": 5,
+    "blob-404": 5,
+}
+
+
+def _digest(data):
+    return "sha256:" + sha256(data).hexdigest()
+
+
+class Registry:
+    """Seeds the stand-ins with repositories and remembers what it put there."""
+
+    def __init__(self, repositories, tags, layers):
+        self.images = []
+        self.small_blobs = []
+        self.large_blobs = []
+
+        dynamodb = boto3.client("dynamodb")
+        s3 = boto3.client("s3")
+        for r in range(repositories):
+            repository = f"team{r}/service"
+            for t in range(tags):
+                self._push(dynamodb, s3, repository, f"v{t}", layers)
+
+    def _push(self, dynamodb, s3, repository, tag, layers):
+        config = json.dumps(dict(repository=repository, tag=tag)).encode()
+        layer_digests = [
+            _digest(f"{repository}:{tag} layer {i}".encode()) for i in range(layers)
+        ]
+        body = json.dumps(
+            dict(
+                schemaVersion=2,
+                mediaType=MEDIA_TYPE,
+                config=dict(size=len(config), digest=_digest(config)),
+                layers=[dict(size=10 << 20, digest=d) for d in layer_digests],
+            )
+        ).encode()
+        digest = _digest(body)
+
+        item = dict(
+            digest=dict(S=digest),
+            media_type=dict(S=MEDIA_TYPE),
+            size=dict(N=str(len(body))),
+            body=dict(B=body),
+        )
+        tag_name = f"{repository}:{tag}"
+        dynamodb.put_item(
+            TableName="manifests",
+            Item=dict(
+                item,
+                name=dict(S=tag_name),
+                repository=dict(S=repository),
+                tag=dict(S=tag),
+            ),
+        )
+        dynamodb.put_item(
+            TableName="manifests",
+            Item=dict(
+                item, name=dict(S=f"{repository}:{digest}"), actual=dict(S=tag_name)
+            ),
+        )
+
+        # Config blobs are small enough to serve inline; layers are redirected
+        s3.put_object(Bucket=BUCKET, Key="blobs/" + _digest(config), Body=config)
+        self._put_blob(dynamodb, _digest(config), len(config))
+        for layer_digest in layer_digests:
+            self._put_blob(dynamodb, layer_digest, 10 << 20)
+
+        self.images.append((repository, tag, digest))
+        self.small_blobs.append((repository, _digest(config)))
+        self.large_blobs.extend((repository, d) for d in layer_digests)
+
+    @staticmethod
+    def _put_blob(dynamodb, digest, size):
+        dynamodb.put_item(
+            TableName="blobs",
+            Item=dict(
+                digest=dict(S=digest),
+                size=dict(N=str(size)),
+                found=dict(BOOL=True),
+                refcount=dict(N="1"),
+            ),
+        )
+
+    def request(self, kind, rng):
+        """Returns the (method, path) of a request of the given kind."""
+
+        repository, tag, digest = rng.choice(self.images)
+        if kind == "manifest-get-tag":
+            return "GET", f"/v2/{repository}/manifests/{tag}"
+        if kind == "manifest-head-tag":
+            return "HEAD", f"/v2/{repository}/manifests/{tag}"
+        if kind == "manifest-get-digest":
+            return "GET", f"/v2/{repository}/manifests/{digest}"
+        if kind == "manifest-404":
+            missing = f"missing-{rng.randrange(1 << 30)}"
+            return "GET", f"/v2/{repository}/manifests/{missing}"
+        if kind == "blob-404":
+            # Clients retry blobs that are still being pushed
+            missing = _digest(b"%d" % rng.randrange(50))
+            return "GET", f"/v2/{repository}/blobs/{missing}"
+
+        repository, blob = rng.choice(
+            self.small_blobs if kind == "blob-inline" else self.large_blobs
+        )
+        return "GET", f"/v2/{repository}/blobs/{blob}"
+
+
+EXPECTED_STATUS = {
+    "manifest-get-tag": 200,
+    "manifest-head-tag": 200,
+    "manifest-get-digest": 200,
+    "blob-inline": 200,
+    "blob-redirect": 302,
+    "manifest-404": 404,
+    # Unknown blobs are redirected; S3 answers the 404
+    "blob-404": 302,
+}
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+def replay(standins, app, registry, args):
+    rng = Random(args.seed)
+    kinds = rng.choices(list(MIX), weights=list(MIX.values()), k=args.requests)
+
+    latencies = defaultdict(list)
+    calls = defaultdict(int)
+    start = perf_counter()
+    # Keep the per-invocation metrics lines out of the report
+    with redirect_stdout(StringIO()):
+        for kind in kinds:
+            method, path = registry.request(kind, rng)
+            event = dict(
+                requestContext=dict(http=dict(method=method, path=path)), headers={}
+            )
+            standins.reset_calls()
+            request_start = perf_counter()
+            response = app.lambda_handler(event, None)
+            latencies[kind].append(perf_counter() - request_start)
+            calls[kind] += standins.total_calls()
+            assert response["statusCode"] == EXPECTED_STATUS[kind], (kind, response)
+    elapsed = perf_counter() - start
+
+    report = dict()
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        report[kind] = dict(
+            p50=percentile(values, 50) * 1000,
+            p99=percentile(values, 99) * 1000,
+            calls=calls[kind] / len(values),
+        )
+
+    overall = sorted(v for values in latencies.values() for v in values)
+    report["all"] = dict(
+        p50=percentile(overall, 50) * 1000,
+        p99=percentile(overall, 99) * 1000,
+        calls=sum(calls.values()) / len(overall),
+        rps=len(overall) / elapsed,
+    )
+    return report
+
+
+def print_report(report):
+    print(f"{'request':>20} {'p50':>9} {'p99':>9} {'calls/req':>9}")
+    for kind, row in report.items():
+        print(
+            f"{kind:>20} {row['p50']:>7.2f}ms {row['p99']:>7.2f}ms "
+            f"{row['calls']:>9.2f}"
+        )
+    print(f"{report['all']['rps']:.0f} requests/s")
+
+
+def compare(report, baseline, tolerance):
+    """Returns a description of every regression against the baseline."""
+
+    regressions = []
+    for kind, row in report.items():
+        base = baseline.get(kind)
+        if base is not None and row["calls"] > base["calls"] * (1 + tolerance):
+            regressions.append(
+                f"{kind}: {row['calls']:.2f} calls/request, was {base['calls']:.2f}"
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--repositories", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--save", action="store_true", help="record a baseline")
+    mode.add_argument("--compare", action="store_true", help="check a baseline")
+    args = parser.parse_args()
+
+    with StandIns(latency=0) as standins:
+        registry = Registry(args.repositories, args.tags, args.layers)
+        app = standins.load("app")
+        standins.latency = args.latency
+        report = replay(standins, app, registry, args)
+
+    print_report(report)
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    key = f"latency={args.latency}"
+    if args.save:
+        baselines[key] = {
+            kind: dict(calls=row["calls"]) for kind, row in report.items()
+        }
+        BASELINES.parent.mkdir(exist_ok=True)
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+    elif args.compare:
+        if key not in baselines:
+            sys.exit(f"No baseline recorded for {key}; run with --save first")
+
+        regressions = compare(report, baselines[key], args.tolerance)
+        if regressions:
+            print("\n".join(regressions))
+            sys.exit(f"{len(regressions)} regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
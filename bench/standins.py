@@ -0,0 +1,176 @@
+"""In-process stand-ins for the registry's AWS dependencies.
+
+The stand-ins are moto's S3 and DynamoDB mocks, laid out like the Pulumi
+program lays out the real resources. A fixed per-call latency can be injected
+to approximate the round trip to the real services, and every AWS call made
+through boto3 is counted.
+
+moto's in-process backends aren't thread-safe, and the functions call them from
+thread pools, so calls are handled one at a time. The injected latency is slept
+outside that lock, so concurrent calls still overlap their round trips.
+"""
+import importlib
+import sys
+from collections import Counter
+from os import environ
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep
+
+import boto3
+import botocore.handlers
+from moto import mock_aws
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BUCKET = "registry"
+
+TABLES = dict(
+    references=[("source", "HASH"), ("digest", "RANGE")],
+    in_references=[("digest", "HASH"), ("source", "RANGE")],
+    manifests=[("name", "HASH")],
+    blobs=[("digest", "HASH")],
+    repositories=[("catalog", "HASH"), ("repository", "RANGE")],
+)
+
+INDEXES = dict(
+    manifests=dict(tags=[("repository", "HASH"), ("tag", "RANGE")]),
+)
+
+
+def _key_schema(keys):
+    return [dict(AttributeName=a, KeyType=t) for a, t in keys]
+
+
+def _create_table(client, name, key_schema):
+    indexes = INDEXES.get(name, {})
+    attributes = {a for a, _ in key_schema}
+    for keys in indexes.values():
+        attributes.update(a for a, _ in keys)
+
+    kwargs = dict()
+    if indexes:
+        kwargs["GlobalSecondaryIndexes"] = [
+            dict(
+                IndexName=index,
+                KeySchema=_key_schema(keys),
+                Projection=dict(ProjectionType="KEYS_ONLY"),
+            )
+            for index, keys in indexes.items()
+        ]
+
+    client.create_table(
+        TableName=name,
+        KeySchema=_key_schema(key_schema),
+        AttributeDefinitions=[
+            dict(AttributeName=a, AttributeType="S") for a in sorted(attributes)
+        ],
+        BillingMode="PAY_PER_REQUEST",
+        **kwargs,
+    )
+
+
+def provision(s3, dynamodb):
+    """Creates the bucket and tables through the given clients."""
+
+    s3.create_bucket(Bucket=BUCKET)
+    s3.put_bucket_versioning(
+        Bucket=BUCKET, VersioningConfiguration=dict(Status="Enabled")
+    )
+    for name, key_schema in TABLES.items():
+        _create_table(dynamodb, name, key_schema)
+
+
+def write_config(task_root, module_name, **options):
+    """Writes the config.ini that app.py or lambda.py reads from its task root."""
+
+    if module_name == "app":
+        config = dict(
+            bucket=BUCKET,
+            manifests="manifests",
+            repositories="repositories",
+            blobs="blobs",
+            debug="true",
+        )
+    else:
+        config = dict(bucket=BUCKET, **{name: name for name in TABLES})
+    config.update(options)
+
+    task_root.mkdir(parents=True, exist_ok=True)
+    lines = ["[default]"] + [f"{k} = {v}" for k, v in config.items()]
+    (task_root / "config.ini").write_text("".join(line + "\n" for line in lines))
+
+
+class StandIns:
+    """Context manager that provisions the stand-ins and loads the functions.
+
+    `latency` is slept before every AWS call, in seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = Lock()
+        # Held by the thread whose call moto is handling
+        self._backend_lock = Lock()
+        self._mock = mock_aws()
+        self._root = Path(mkdtemp(prefix="registry-bench-"))
+
+    def __enter__(self):
+        environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        environ["AWS_ACCESS_KEY_ID"] = "testing"
+        environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+        self._mock.start()
+
+        # Registered as builtins so that they also reach any sessions the
+        # functions create.
+        self._handlers = [
+            ("before-call", self._before_call),
+            ("after-call", self._after_call),
+            ("after-call-error", self._after_call),
+        ]
+        botocore.handlers.BUILTIN_HANDLERS.extend(self._handlers)
+        boto3.setup_default_session()
+
+        provision(boto3.client("s3"), boto3.client("dynamodb"))
+        self.reset_calls()
+        return self
+
+    def __exit__(self, *exc_info):
+        for handler in self._handlers:
+            botocore.handlers.BUILTIN_HANDLERS.remove(handler)
+        self._mock.stop()
+
+    def _before_call(self, event_name, **kwargs):
+        # event_name looks like "before-call.s3.GetObject"
+        with self._lock:
+            self.calls[event_name.split(".", 1)[1]] += 1
+
+        if self.latency:
+            sleep(self.latency)
+
+        self._backend_lock.acquire()
+
+    def _after_call(self, **kwargs):
+        self._backend_lock.release()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def load(self, module_name, **options):
+        """Imports a fresh copy of app.py or lambda.py against the stand-ins."""
+
+        task_root = self._root / module_name
+        write_config(task_root, module_name, **options)
+        environ["LAMBDA_TASK_ROOT"] = str(task_root)
+
+        if str(ROOT) not in sys.path:
+            sys.path.insert(0, str(ROOT))
+        sys.modules.pop(module_name, None)
+        return importlib.import_module(module_name)
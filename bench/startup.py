@@ -0,0 +1,169 @@
+"""Measures cold starts: the time from importing a function to its first response.
+
+Every sample runs in a fresh interpreter, as a new Lambda execution environment
+would, with S3 and DynamoDB stood in for by moto in server mode. The read path
+answers a manifest pull and the indexer verifies an uploaded blob.
+
+    python bench/startup.py --samples 20 --max-ms 1500
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+from hashlib import sha256
+from os import environ
+from pathlib import Path
+from statistics import median
+from tempfile import mkdtemp
+
+import boto3
+from moto.server import ThreadedMotoServer
+from standins import BUCKET
+from standins import provision
+from standins import ROOT
+from standins import write_config
+
+# Runs in the fresh interpreter: argv is the module name and the event to handle
+CHILD = """
+import json
+import sys
+from time import perf_counter
+
+start = perf_counter()
+module = __import__(sys.argv[1])
+imported = perf_counter()
+response = module.lambda_handler(json.loads(sys.argv[2]), None)
+responded = perf_counter()
+
+status = response.get("statusCode", 200) if response else 200
+print(json.dumps(dict(imported=imported - start, responded=responded - start,
+                      status=status)))
+"""
+
+MANIFEST = json.dumps(
+    dict(
+        schemaVersion=2,
+        mediaType="application/vnd.docker.distribution.manifest.v2+json",
+        config=dict(size=0, digest="sha256:" + sha256(b"").hexdigest()),
+        layers=[],
+    )
+).encode()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed(endpoint):
+    """Provisions the stand-ins and returns the event each function handles."""
+
+    s3 = boto3.client("s3", endpoint_url=endpoint)
+    dynamodb = boto3.client("dynamodb", endpoint_url=endpoint)
+    provision(s3, dynamodb)
+
+    digest = "sha256:" + sha256(MANIFEST).hexdigest()
+    dynamodb.put_item(
+        TableName="manifests",
+        Item=dict(
+            name=dict(S="bench:latest"),
+            digest=dict(S=digest),
+            media_type=dict(S=json.loads(MANIFEST)["mediaType"]),
+            size=dict(N=str(len(MANIFEST))),
+            body=dict(B=MANIFEST),
+        ),
+    )
+
+    layer = b"layer" * 1024
+    key = "blobs/sha256:" + sha256(layer).hexdigest()
+    version = s3.put_object(Bucket=BUCKET, Key=key, Body=layer)["VersionId"]
+
+    return dict(
+        app=dict(
+            requestContext=dict(
+                http=dict(method="GET", path="/v2/bench/manifests/latest")
+            ),
+            headers=dict(),
+        ),
+        # Digest keys contain ':', which S3 URL-encodes in notifications
+        indexer=dict(
+            Records=[
+                dict(
+                    eventSource="aws:s3",
+                    eventName="ObjectCreated:Put",
+                    s3=dict(
+                        bucket=dict(name=BUCKET),
+                        object=dict(key=key.replace(":", "%3A"), versionId=version),
+                    ),
+                )
+            ]
+        ),
+    )
+
+
+def sample(module_name, task_root, endpoint, event):
+    env = dict(
+        environ,
+        AWS_ENDPOINT_URL=endpoint,
+        LAMBDA_TASK_ROOT=str(task_root),
+        PYTHONPATH=str(ROOT),
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, module_name, json.dumps(event)],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(out.splitlines()[-1])
+    assert result["status"] == 200, f"{module_name} responded {result['status']}"
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        help="exit non-zero if a median import-to-first-response exceeds this",
+    )
+    args = parser.parse_args()
+
+    environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    environ["AWS_ACCESS_KEY_ID"] = "testing"
+    environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+
+    port = _free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    try:
+        endpoint = f"http://127.0.0.1:{port}"
+        events = seed(endpoint)
+        root = Path(mkdtemp(prefix="registry-startup-"))
+
+        regressed = False
+        print(f"{'function':>8} {'import':>10} {'first response':>15}")
+        for name, module_name in (("app", "app"), ("indexer", "lambda")):
+            task_root = root / module_name
+            write_config(task_root, module_name)
+            results = [
+                sample(module_name, task_root, endpoint, events[name])
+                for _ in range(args.samples)
+            ]
+            imported = median(r["imported"] for r in results) * 1000
+            responded = median(r["responded"] for r in results) * 1000
+            print(f"{name:>8} {imported:>8.1f}ms {responded:>13.1f}ms")
+            if args.max_ms is not None and responded > args.max_ms:
+                regressed = True
+    finally:
+        server.stop()
+
+    if regressed:
+        sys.exit(f"Median cold start exceeded {args.max_ms}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Benchmarks what token authentication adds to each read-path request.
+
+The same manifest requests are replayed against the read path without auth,
+with tokens it sees for the first time, and with tokens it has already
+verified. Tokens are RS256 JWTs signed with a freshly generated key, as a token
+server would issue them, each granting pull on one repository.
+
+    python bench/token_auth.py --requests 2000 --clients 50 --key-bits 2048
+
+The time spent authorizing is also measured on its own, since it is small next
+to the stand-ins' own overhead.
+"""
+import argparse
+import json
+from base64 import urlsafe_b64encode
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+from time import time
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from read_path import percentile
+from read_path import Registry
+from standins import StandIns
+
+ISSUER = "bench-token-server"
+SERVICE = "bench-registry"
+
+
+def _b64(data):
+    return urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64_int(n):
+    return _b64(n.to_bytes((n.bit_length() + 7) // 8, "big"))
+
+
+class TokenServer:
+    """Signs tokens the way a registry token server does."""
+
+    def __init__(self, key_bits):
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=key_bits)
+
+    def jwks(self):
+        numbers = self._key.public_key().public_numbers()
+        jwk = dict(
+            kty="RSA",
+            alg="RS256",
+            use="sig",
+            kid="bench",
+            n=_b64_int(numbers.n),
+            e=_b64_int(numbers.e),
+        )
+        return json.dumps(dict(keys=[jwk]))
+
+    def token(self, client, repository, ttl=3600):
+        header = _b64(json.dumps(dict(alg="RS256", typ="JWT", kid="bench")).encode())
+        claims = dict(
+            iss=ISSUER,
+            sub=f"client{client}",
+            aud=SERVICE,
+            exp=int(time()) + ttl,
+            iat=int(time()),
+            access=[dict(type="repository", name=repository, actions=["pull"])],
+        )
+        payload = _b64(json.dumps(claims).encode())
+        signature = self._key.sign(
+            f"{header}.{payload}".encode(), padding.PKCS1v15(), hashes.SHA256()
+        )
+        return f"{header}.{payload}.{_b64(signature)}"
+
+
+def _event(path, token=None, method="HEAD"):
+    headers = dict() if token is None else dict(authorization=f"Bearer {token}")
+    http = dict(method=method, path=path)
+    return dict(requestContext=dict(http=http), headers=headers)
+
+
+def replay(app, requests, tokens):
+    """Times each request; `tokens` maps a request index to its token."""
+
+    latencies = []
+    # Keep the per-invocation metrics lines out of the report
+    with redirect_stdout(StringIO()):
+        for i, path in enumerate(requests):
+            event = _event(path, tokens.get(i))
+            start = perf_counter()
+            response = app.lambda_handler(event, None)
+            latencies.append(perf_counter() - start)
+            assert response["statusCode"] == 200, response
+
+    return sorted(latencies)
+
+
+def check_rejections(app, server, repository, other):
+    """Returns a description of every request that should have been refused."""
+
+    path = f"/v2/{repository}/manifests/v0"
+    cases = dict(
+        missing=None,
+        forged=server.token(0, repository)[:-4] + "AAAA",
+        expired=server.token(0, repository, ttl=-3600),
+        other_repository=server.token(0, other),
+    )
+    problems = []
+    with redirect_stdout(StringIO()):
+        for case, token in cases.items():
+            response = app.lambda_handler(_event(path, token), None)
+            if response["statusCode"] != 401:
+                problems.append(f"{case}: {response['statusCode']}, expected 401")
+            elif "WWW-Authenticate" not in response["headers"]:
+                problems.append(f"{case}: no challenge")
+
+    return problems
+
+
+def time_authorize(app, path, token, repository, n):
+    """The mean seconds spent authorizing one request with a verified token."""
+
+    request = app.App("HEAD", path, dict(authorization=f"Bearer {token}"))
+    start = perf_counter()
+    for _ in range(n):
+        assert request._authorize("repository", repository, "pull") is None
+    return (perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--key-bits", type=int, default=2048)
+    parser.add_argument("--repositories", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = TokenServer(args.key_bits)
+    jwks = Path(mkdtemp(prefix="registry-auth-")) / "jwks.json"
+    jwks.write_text(server.jwks())
+
+    rng = Random(args.seed)
+    with StandIns(latency=0) as standins:
+        registry = Registry(args.repositories, args.tags, layers=1)
+        images = [rng.choice(registry.images) for _ in range(args.requests)]
+        clients = [rng.randrange(args.clients) for _ in range(args.requests)]
+        requests = [f"/v2/{r}/manifests/{tag}" for r, tag, _ in images]
+
+        # Each client holds one token per repository, as the docker CLI does
+        issued = dict()
+        tokens = dict()
+        for i, ((repository, _, _), client) in enumerate(zip(images, clients)):
+            key = (client, repository)
+            if key not in issued:
+                issued[key] = server.token(client, repository)
+            tokens[i] = issued[key]
+
+        app = standins.load("app")
+        replay(app, requests, dict())
+        without_auth = replay(app, requests, dict())
+
+        app = standins.load(
+            "app",
+            auth_jwks=jwks,
+            auth_realm="https://auth.example.com/token",
+            auth_service=SERVICE,
+            auth_issuer=ISSUER,
+        )
+        # The first request with each token pays for verifying it
+        first_use = {token: i for i, token in reversed(tokens.items())}
+        first_use = sorted(first_use.values())
+        cold = replay(
+            app,
+            [requests[i] for i in first_use],
+            {j: tokens[i] for j, i in enumerate(first_use)},
+        )
+        warm = replay(app, requests, tokens)
+
+        repository, tag, _ = registry.images[0]
+        other = registry.images[-1][0]
+        token = server.token(0, repository)
+        path = f"/v2/{repository}/manifests/{tag}"
+        # The first call verifies the token
+        time_authorize(app, path, token, repository, 1)
+        cached = time_authorize(app, path, token, repository, 10000)
+        start = perf_counter()
+        for _ in range(100):
+            app.KEYS.verify(token)
+        verify = (perf_counter() - start) / 100
+        problems = check_rejections(app, server, repository, other)
+
+    print(f"{'requests':>20} {'p50':>9} {'p99':>9}")
+    rows = (
+        ("no auth", without_auth),
+        ("new token", cold),
+        ("verified token", warm),
+    )
+    for name, values in rows:
+        print(
+            f"{name:>20} {percentile(values, 50) * 1000:>7.3f}ms "
+            f"{percentile(values, 99) * 1000:>7.3f}ms"
+        )
+    print(f"Verifying a {args.key_bits}-bit RS256 token: {verify * 1e6:.1f}us")
+    print(f"Authorizing with a verified token: {cached * 1e6:.1f}us")
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(f"{len(problems)} requests weren't refused")
+
+
+if __name__ == "__main__":
+    main()
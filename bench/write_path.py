@@ -0,0 +1,397 @@
+"""Benchmarks indexing throughput with a synthetic, registry-sized workload.
+
+Thousands of manifests are generated whose layers are drawn from a shared pool
+with a Zipf-like distribution, as base images are shared in a real registry.
+Their blobs and manifests are uploaded to the stand-ins, and the matching S3
+notifications are fed to lambda.py in SQS-sized batches. Some tags share their
+manifest with an earlier tag in the same repository. A fraction of the tags
+are then pushed again with new layers, and another fraction deleted, which
+drives garbage collection. S3 delivers at least once and out of order, so some
+of the events are then delivered again, shuffled. Finally a consistency check
+compares refcounts, references, blob presence and the manifests table, including
+digest aliases, against the workload.
+
+    python bench/write_path.py --manifests 20000 --blobs 5000 --zipf 1.1
+
+DynamoDB units are estimated from each call's request and response, using
+on-demand pricing rules: a write unit per 1 KB written, a read unit per 4 KB
+read (half for eventually consistent reads), and double for transactions.
+"""
+import argparse
+import json
+import math
+from collections import Counter
+from collections import defaultdict
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+from itertools import accumulate
+from random import Random
+from time import perf_counter
+from urllib.parse import quote_plus
+
+import boto3
+from standins import BUCKET
+from standins import StandIns
+
+MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+
+
+def _digest(data):
+    return "sha256:" + sha256(data).hexdigest()
+
+
+def _size(value):
+    """The approximate stored size of a typed DynamoDB item or key."""
+    return len(json.dumps(value, default=len))
+
+
+class CapacityEstimator:
+    """Estimates the read and write units of every DynamoDB call it observes."""
+
+    def __init__(self):
+        self.reads = 0.0
+        self.writes = 0.0
+
+    def observe(self, event_name, parsed, context, **kwargs):
+        params = context.get("bench_params", {})
+        operation = event_name.rsplit(".", 1)[1]
+        if operation in ("GetItem", "Query", "Scan"):
+            items = [parsed["Item"]] if "Item" in parsed else parsed.get("Items", [])
+            size = sum(_size(item) for item in items)
+            factor = 1 if params.get("ConsistentRead") else 0.5
+            self.reads += factor * max(1, math.ceil(size / 4096))
+        elif operation == "BatchGetItem":
+            for items in parsed.get("Responses", {}).values():
+                self.reads += sum(
+                    0.5 * max(1, math.ceil(_size(item) / 4096)) for item in items
+                )
+        elif operation in ("PutItem", "UpdateItem", "DeleteItem"):
+            item = params.get("Item") or params.get("Key", {})
+            self.writes += max(1, math.ceil(_size(item) / 1024))
+        elif operation == "BatchWriteItem":
+            for requests in params.get("RequestItems", {}).values():
+                for request in requests:
+                    item = request.get("PutRequest", {}).get("Item", {})
+                    self.writes += max(1, math.ceil(_size(item) / 1024))
+        elif operation == "TransactWriteItems":
+            self.writes += 2 * len(params.get("TransactItems", []))
+
+    @staticmethod
+    def remember_params(params, context, **kwargs):
+        context["bench_params"] = params
+
+    def snapshot(self):
+        return self.reads, self.writes
+
+
+class Workload:
+    """Synthesizes manifests over a shared pool of layers."""
+
+    def __init__(self, args):
+        rng = Random(args.seed)
+        self.layers = [b"layer %d" % i for i in range(args.blobs)]
+        # The i-th most popular layer is chosen with weight 1 / i**s
+        weights = list(accumulate(1 / (i + 1) ** args.zipf for i in range(args.blobs)))
+
+        self.configs = dict()
+        self.manifests = dict()
+        for m in range(args.manifests):
+            repository = f"repo{m % args.repositories}"
+            name = f"{repository}:tag{m}"
+            if m >= args.repositories and rng.random() < args.share_fraction:
+                # The same image under a second tag, like latest and a version.
+                # Both tags then own its digest alias.
+                other = f"{repository}:tag{m - args.repositories}"
+                self.manifests[name] = self.manifests[other]
+            else:
+                self.manifests[name] = self._manifest(
+                    rng, args, weights, dict(name=name)
+                )
+
+        names = sorted(self.manifests)
+        self.deleted = set(rng.sample(names, int(len(names) * args.delete_fraction)))
+
+        # Pushed again with new layers. None of these are deleted.
+        kept = [name for name in names if name not in self.deleted]
+        self.retagged = {
+            name: self._manifest(rng, args, weights, dict(name=name, push=2))
+            for name in rng.sample(kept, int(len(kept) * args.retag_fraction))
+        }
+
+    def _manifest(self, rng, args, weights, config):
+        count = rng.randint(args.min_layers, args.max_layers)
+        layers = set()
+        while len(layers) < min(count, args.blobs):
+            layers.update(rng.choices(range(args.blobs), cum_weights=weights))
+
+        config = json.dumps(config).encode()
+        self.configs[_digest(config)] = config
+        return json.dumps(
+            dict(
+                schemaVersion=2,
+                mediaType=MEDIA_TYPE,
+                config=dict(
+                    mediaType=CONFIG_MEDIA_TYPE,
+                    size=len(config),
+                    digest=_digest(config),
+                ),
+                layers=[
+                    dict(size=len(self.layers[i]), digest=_digest(self.layers[i]))
+                    for i in sorted(layers)
+                ],
+            )
+        ).encode()
+
+    def live(self):
+        """The manifest each tag ends up with, for the tags that aren't deleted."""
+
+        return {
+            name: self.retagged.get(name, body)
+            for name, body in self.manifests.items()
+            if name not in self.deleted
+        }
+
+    def blobs(self):
+        """Every blob referenced by some manifest, by digest."""
+
+        referenced = set()
+        for body in [*self.manifests.values(), *self.retagged.values()]:
+            referenced.update(self.references(body))
+
+        by_digest = {_digest(layer): layer for layer in self.layers}
+        by_digest.update(self.configs)
+        return {digest: by_digest[digest] for digest in referenced}
+
+    @staticmethod
+    def references(body):
+        manifest = json.loads(body)
+        return {manifest["config"]["digest"]} | {
+            layer["digest"] for layer in manifest["layers"]
+        }
+
+
+class Notifier:
+    """Uploads objects and builds the S3 notifications they would produce."""
+
+    def __init__(self):
+        self._s3 = boto3.client("s3")
+        self._sequencer = 0
+
+    def _record(self, event_name, key, version_id):
+        self._sequencer += 1
+        return dict(
+            eventSource="aws:s3",
+            eventName=event_name,
+            s3=dict(
+                bucket=dict(name=BUCKET),
+                object=dict(
+                    key=quote_plus(key, safe="/"),
+                    versionId=version_id,
+                    sequencer=format(self._sequencer, "016X"),
+                ),
+            ),
+        )
+
+    def put(self, key, body):
+        resp = self._s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        return self._record("ObjectCreated:Put", key, resp["VersionId"])
+
+    def delete(self, key):
+        resp = self._s3.delete_object(Bucket=BUCKET, Key=key)
+        return self._record("ObjectRemoved:DeleteMarkerCreated", key, resp["VersionId"])
+
+
+def deliver(lambda_, records, batch_size):
+    """Feeds records to the indexer in SQS batches. Returns the failure count."""
+
+    failures = 0
+    for i in range(0, len(records), batch_size):
+        event = dict(
+            Records=[
+                dict(
+                    eventSource="aws:sqs",
+                    messageId=str(i + j),
+                    body=json.dumps(dict(Records=[r])),
+                )
+                for j, r in enumerate(records[i : i + batch_size])
+            ]
+        )
+        resp = lambda_.lambda_handler(event, None)
+        failures += len(resp["batchItemFailures"])
+
+    return failures
+
+
+def run_phase(standins, lambda_, estimator, name, records, args):
+    standins.reset_calls()
+    reads, writes = estimator.snapshot()
+    start = perf_counter()
+    # Keep the per-invocation metrics lines out of the report
+    with redirect_stdout(StringIO()):
+        failures = deliver(lambda_, records, args.batch_size)
+    elapsed = perf_counter() - start
+    new_reads, new_writes = estimator.snapshot()
+
+    n = max(1, len(records))
+    print(
+        f"{name:>10} {len(records):>8} {len(records) / elapsed:>10.1f} "
+        f"{standins.total_calls() / n:>10.2f} {(new_reads - reads) / n:>9.2f} "
+        f"{(new_writes - writes) / n:>9.2f} {failures:>8}"
+    )
+
+
+def check_consistency(workload):
+    """Compares what the indexer recorded with what the workload implies.
+    Returns a list of problems."""
+
+    dynamodb = boto3.resource("dynamodb")
+    s3 = boto3.client("s3")
+    problems = []
+
+    expected = Counter()
+    live = workload.live()
+    for body in live.values():
+        expected.update(workload.references(body))
+
+    def scan(table):
+        kwargs = dict()
+        while True:
+            resp = dynamodb.Table(table).scan(**kwargs)
+            yield from resp["Items"]
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+    items = {item["name"]: item for item in scan("manifests")}
+    rows = {row["digest"]: row for row in scan("blobs")}
+    in_refs = Counter(row["digest"] for row in scan("in_references"))
+    out_refs = defaultdict(set)
+    for row in scan("references"):
+        out_refs[row["source"]].add(row["digest"])
+
+    present = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix="blobs/"):
+        present.update(obj["Key"][len("blobs/") :] for obj in page.get("Contents", []))
+
+    for digest in workload.blobs():
+        want = expected[digest]
+        row = rows.get(digest)
+        refcount = int(row.get("refcount", 0)) if row else 0
+        if refcount != want:
+            problems.append(f"{digest}: refcount {refcount}, expected {want}")
+        if in_refs[digest] != want:
+            problems.append(f"{digest}: {in_refs[digest]} in_refs, expected {want}")
+        if (digest in present) != (want > 0):
+            state = "present" if digest in present else "missing"
+            problems.append(f"{digest}: {state} in S3 with {want} references")
+
+    for name in workload.manifests:
+        want = workload.references(live[name]) if name in live else set()
+        if out_refs.get(name, set()) != want:
+            problems.append(f"{name}: outbound references don't match its manifest")
+
+    # Pulls by digest resolve through aliases, which must only name live content,
+    # and are owned by every live tag with that digest
+    aliases = defaultdict(set)
+    for name, body in live.items():
+        aliases[f"{name.split(':')[0]}:{_digest(body)}"].add(name)
+    for name, item in items.items():
+        if "actual" in item:
+            if name not in aliases:
+                problems.append(f"{name}: stale alias of {item['actual']}")
+            elif set(item.get("owners", ())) != aliases[name]:
+                problems.append(f"{name}: owned by {sorted(item.get('owners', ()))}")
+        elif "claimed" in item:
+            problems.append(f"{name}: still claimed by {item['claimed']}")
+        elif name not in live:
+            if "expires" not in item:
+                problems.append(f"{name}: deleted but still indexed")
+        elif "expires" in item or item.get("digest") != _digest(live[name]):
+            problems.append(f"{name}: not indexed as its latest push")
+
+    for alias, names in aliases.items():
+        if alias not in items:
+            problems.append(f"{alias}: missing alias of {sorted(names)}")
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--manifests", type=int, default=2000)
+    parser.add_argument("--repositories", type=int, default=100)
+    parser.add_argument("--blobs", type=int, default=1000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--min-layers", type=int, default=3)
+    parser.add_argument("--max-layers", type=int, default=15)
+    parser.add_argument("--delete-fraction", type=float, default=0.3)
+    parser.add_argument("--share-fraction", type=float, default=0.2)
+    parser.add_argument("--retag-fraction", type=float, default=0.2)
+    parser.add_argument("--replay-fraction", type=float, default=0.2)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workload = Workload(args)
+    with StandIns(latency=0) as standins:
+        lambda_ = standins.load("lambda")
+        estimator = CapacityEstimator()
+        events = lambda_.dynamodb_client.meta.events
+        events.register("before-parameter-build.dynamodb", estimator.remember_params)
+        events.register("after-call.dynamodb", estimator.observe)
+
+        notifier = Notifier()
+        blob_records = [
+            notifier.put("blobs/" + digest, body)
+            for digest, body in workload.blobs().items()
+        ]
+        manifest_records = [
+            notifier.put("manifests/" + name, body)
+            for name, body in workload.manifests.items()
+        ]
+
+        print(
+            f"{'phase':>10} {'events':>8} {'events/s':>10} {'calls/ev':>10} "
+            f"{'RRU/ev':>9} {'WRU/ev':>9} {'failures':>8}"
+        )
+        standins.latency = args.latency
+        run_phase(standins, lambda_, estimator, "blobs", blob_records, args)
+        run_phase(standins, lambda_, estimator, "manifests", manifest_records, args)
+        standins.latency = 0
+
+        retag_records = [
+            notifier.put("manifests/" + name, body)
+            for name, body in workload.retagged.items()
+        ]
+        standins.latency = args.latency
+        run_phase(standins, lambda_, estimator, "retags", retag_records, args)
+        standins.latency = 0
+
+        delete_records = [
+            notifier.delete("manifests/" + name) for name in sorted(workload.deleted)
+        ]
+        standins.latency = args.latency
+        run_phase(standins, lambda_, estimator, "deletes", delete_records, args)
+
+        # Redelivered, and mostly older than what was since applied
+        rng = Random(args.seed)
+        delivered = manifest_records + retag_records + delete_records
+        replays = rng.sample(delivered, int(len(delivered) * args.replay_fraction))
+        run_phase(standins, lambda_, estimator, "replays", replays, args)
+        standins.latency = 0
+
+        problems = check_consistency(workload)
+
+    for problem in problems[:50]:
+        print(problem)
+    if problems:
+        raise SystemExit(f"{len(problems)} consistency problems")
+    print("Consistent")
+
+
+if __name__ == "__main__":
+    main()
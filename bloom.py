@@ -0,0 +1,56 @@
+"""A Bloom filter of manifest names.
+
+The indexer publishes one to the bucket, and the read path uses it to answer
+requests for names that definitely don't exist without calling AWS.
+"""
+import struct
+from hashlib import blake2b
+from math import ceil
+from math import log
+
+# magic, generation, number of bits, number of hashes
+HEADER = struct.Struct("!4sQQB")
+MAGIC = b"RBF1"
+
+
+class BloomFilter:
+    def __init__(self, bits, hashes, generation=0, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.generation = generation
+        if data is None:
+            data = bytes((bits + 7) // 8)
+        self._data = bytearray(data)
+
+    @classmethod
+    def for_capacity(cls, n, error_rate=0.01, generation=0):
+        n = max(n, 1)
+        bits = ceil(-n * log(error_rate) / log(2) ** 2)
+        hashes = max(1, round(bits / n * log(2)))
+        return cls(bits, hashes, generation)
+
+    def _positions(self, key):
+        # Kirsch-Mitzenmacher: k positions from two independent hashes
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._data[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self._data[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def dumps(self):
+        header = HEADER.pack(MAGIC, self.generation, self.bits, self.hashes)
+        return header + bytes(self._data)
+
+    @classmethod
+    def loads(cls, blob):
+        magic, generation, bits, hashes = HEADER.unpack_from(blob)
+        if magic != MAGIC:
+            raise ValueError("Not a serialized BloomFilter")
+
+        return cls(bits, hashes, generation, blob[HEADER.size :])
@@ -1,18 +1,29 @@
 import json
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from functools import cache
 from hashlib import sha256
 from itertools import islice
+from itertools import repeat
 from os import environ
+from random import random
+from time import sleep
 from time import time
+from traceback import print_exc
 from urllib.parse import unquote_plus
 
 import boto3
 import botocore
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
 
-
-s3 = boto3.client("s3")
-ObjectVersion = boto3.resource("s3").ObjectVersion
+from bloom import BloomFilter
+from metrics import Metrics
+from metrics import profiled
 
 
 class dotdict(dict):
@@ -35,68 +46,368 @@ def chunks(xs, n):
             break
 
 
+def backoff(attempt):
+    """Sleeps with full-jitter exponential backoff before retry number `attempt`."""
+    sleep(random() * min(2.0, 0.05 * 2**attempt))
+
+
 parser = ConfigParser()
 parser.read(environ["LAMBDA_TASK_ROOT"] + "/config.ini")
 config = parser["default"]
-BUCKET = boto3.resource("s3").Bucket(config.pop("bucket"))
-
-DYNAMODB = boto3.resource("dynamodb")
+BUCKET_NAME = config.pop("bucket")
+# Manifests at or under this many bytes are stored inline in the manifests table,
+# which lets the read path skip S3 entirely.
+MANIFEST_INLINE_LIMIT = int(config.pop("manifest_inline_limit", "65536"))
+MAX_WORKERS = int(config.pop("max_workers", "16"))
+MAX_RECORD_WORKERS = int(config.pop("max_record_workers", "4"))
+# Uploaded blobs are verified in ranges of this many bytes, this many at a time
+VERIFY_RANGE_SIZE = int(config.pop("verify_range_size", str(8 * 1024 * 1024)))
+VERIFY_RANGES = int(config.pop("verify_ranges", "8"))
+# The fraction of invocations to profile with cProfile
+PROFILE_SAMPLE_RATE = float(config.pop("profile_sample_rate", "0"))
+# How long an event's claim on a manifest name lasts. Matches the indexer's
+# timeout, so that the claims of invocations that timed out are taken over.
+CLAIM_SECONDS = int(config.pop("claim_seconds", "900"))
+# Whether the read path turns away names missing from the published filter
+NAME_FILTER = config.pop("name_filter", "false") == "true"
+# Claims held by earlier events are usually released within seconds
+CLAIM_ATTEMPTS = 8
+# Until an earlier event's claim runs out, its messages are retried after this
+# many seconds, doubling with every receive. Five receives span a whole claim.
+CLAIM_RETRY_DELAY = int(config.pop("claim_retry_delay", "30"))
+BATCH_GET_ATTEMPTS = 8
+BATCH_WRITE_ATTEMPTS = 8
+RECENT_NAMES_ATTEMPTS = 8
+# A GSI on the manifests table, keyed by (repository, tag)
+TAGS_INDEX = "tags"
+# The partition key of every row in the repositories table
+CATALOG = "default"
+NAME_FILTER_KEY = "filters/manifest-names"
+# Tags created since the filter was published, with the time they were created
+RECENT_NAMES_KEY = "filters/manifest-names-recent"
+
+# Every invocation talks to both services, so their clients are created during
+# Lambda init. Only low-level clients are used: they are thread-safe, and loading
+# boto3's resource models is a large share of a cold start.
+METRICS = Metrics("indexer")
+# Sized so that no pool thread waits for a connection
+CLIENT_CONFIG = Config(max_pool_connections=MAX_WORKERS + MAX_RECORD_WORKERS)
+s3 = METRICS.instrument(boto3.client("s3", config=CLIENT_CONFIG))
+dynamodb_client = METRICS.instrument(boto3.client("dynamodb", config=CLIENT_CONFIG))
+POOL = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Separate from POOL: record handlers block on work they submit to POOL.
+RECORD_POOL = ThreadPoolExecutor(max_workers=MAX_RECORD_WORKERS)
 TABLE_NAMES = dotdict(**config)
 
 
-TABLES = dotdict(
-    (nickname, DYNAMODB.Table(name)) for nickname, name in TABLE_NAMES.items()
-)
+@cache
+def sqs_client():
+    """SQS is only needed to delay retries, so its client is created on first use."""
+    return METRICS.instrument(boto3.client("sqs", config=CLIENT_CONFIG))
+
+
+SERIALIZER = TypeSerializer()
+DESERIALIZER = TypeDeserializer()
+
+
+def marshal(item):
+    """Converts an item of plain Python values to DynamoDB's typed form."""
+    return {k: SERIALIZER.serialize(v) for k, v in item.items()}
+
+
+def unmarshal(item):
+    return {k: DESERIALIZER.deserialize(v) for k, v in item.items()}
+
+
+def batch_write(table_name, requests):
+    """Applies put and delete requests 25 at a time, retrying unprocessed ones."""
+
+    for chunk in chunks(requests, 25):
+        request = {table_name: chunk}
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                backoff(attempt)
+
+            resp = dynamodb_client.batch_write_item(RequestItems=request)
+            request = resp.get("UnprocessedItems")
+            if not request:
+                break
+        else:
+            raise RuntimeError(f"Items still unprocessed after {attempt + 1} attempts")
+
+
+class ObjectVersion(namedtuple("ObjectVersion", "bucket_name object_key id")):
+    """A specific version of an S3 object, fetched with the thread-safe client."""
+
+    def get(self):
+        return s3.get_object(
+            Bucket=self.bucket_name, Key=self.object_key, VersionId=self.id
+        )
 
 
 class Blob:
-    def __init__(self, digest):
-        self._digest = digest
-        self._s3 = BUCKET.Object("blobs/" + digest)
+    @staticmethod
+    def _delete_row(digest, seen=0):
+        """Deletes a blob's row unless it has gained references in the meantime,
+        which would have raised its refcount above `seen`."""
+
+        try:
+            dynamodb_client.delete_item(
+                TableName=TABLE_NAMES.blobs,
+                Key=dict(digest=dict(S=digest)),
+                ConditionExpression=(
+                    "attribute_not_exists(refcount) OR refcount <= :seen"
+                ),
+                ExpressionAttributeValues={":seen": dict(N=str(seen))},
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    @classmethod
+    def batch_delete(cls, digests, seen=None):
+        """Deletes unreferenced blobs: their rows first, then their S3 objects.
+        Returns the digests that were deleted.
+
+        `seen` maps digests to refcounts read before they were found unreferenced,
+        for counts that leaked above zero. Other rows must be at zero.
+        """
+
+        seen = seen or dict()
+        rows_deleted = POOL.map(
+            cls._delete_row, digests, [seen.get(d, 0) for d in digests]
+        )
+        digests = [digest for digest, ok in zip(digests, rows_deleted) if ok]
+
+        for chunk in chunks(digests, 1000):
+            resp = s3.delete_objects(
+                Bucket=BUCKET_NAME,
+                Delete=dict(
+                    Objects=[dict(Key="blobs/" + digest) for digest in chunk],
+                    Quiet=True,
+                ),
+            )
+            if errors := resp.get("Errors"):
+                raise RuntimeError(f"Failed to delete {len(errors)} blobs: {errors}")
+
+        return digests
+
+    @staticmethod
+    def add_reference(digest, source, *, found: bool):
+        """Writes an in_ref and counts it on the blob's row, atomically.
 
-    def delete(self):
-        self._s3.delete()
-        TABLES.blobs.delete_item(Key=dict(digest=self._digest))
+        Redelivered writes of an existing in_ref are not counted twice.
+        """
 
-    def _exists_in_s3(self):
         try:
-            self._s3.load()
+            dynamodb_client.transact_write_items(
+                TransactItems=[
+                    dict(
+                        Put=dict(
+                            TableName=TABLE_NAMES.in_references,
+                            Item=dict(digest=dict(S=digest), source=dict(S=source)),
+                            ConditionExpression="attribute_not_exists(digest)",
+                        )
+                    ),
+                    dict(
+                        Update=dict(
+                            TableName=TABLE_NAMES.blobs,
+                            Key=dict(digest=dict(S=digest)),
+                            UpdateExpression=(
+                                "ADD refcount :one "
+                                "SET #found = if_not_exists(#found, :found)"
+                            ),
+                            ExpressionAttributeNames={"#found": "found"},
+                            ExpressionAttributeValues={
+                                ":one": dict(N="1"),
+                                ":found": dict(BOOL=found),
+                            },
+                        )
+                    ),
+                ]
+            )
+        except dynamodb_client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+                raise
+
+    @staticmethod
+    def remove_reference(digest, source):
+        """Deletes an in_ref and uncounts it from the blob's row.
+
+        Returns whether the blob is now unreferenced. A count that reaches zero
+        is confirmed against in_references before it is believed.
+        """
+
+        resp = dynamodb_client.delete_item(
+            TableName=TABLE_NAMES.in_references,
+            Key=dict(digest=dict(S=digest), source=dict(S=source)),
+            ReturnValues="ALL_OLD",
+        )
+        if "Attributes" not in resp:
+            # Already removed and uncounted by an earlier attempt
+            return False
+
+        # Unlike add_reference this isn't transactional: if we die right here
+        # the blob leaks rather than being deleted while still referenced.
+        try:
+            resp = dynamodb_client.update_item(
+                TableName=TABLE_NAMES.blobs,
+                Key=dict(digest=dict(S=digest)),
+                UpdateExpression="ADD refcount :minus_one",
+                ConditionExpression="refcount > :zero",
+                ExpressionAttributeValues={
+                    ":minus_one": dict(N="-1"),
+                    ":zero": dict(N="0"),
+                },
+                ReturnValues="UPDATED_NEW",
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            # Blobs indexed before refcounting existed have no count to decrement
+            return Blob.is_unreferenced(digest)
+
+        if int(resp["Attributes"]["refcount"]["N"]) > 0:
+            return False
+
+        # Rows indexed before refcounting existed only count the references made
+        # since, so the in_refs of older manifests must be counted too.
+        return Blob.is_unreferenced(digest)
+
+    @staticmethod
+    def refcount(digest):
+        """Returns the blob's refcount, which is 0 if it has no row or no count."""
+
+        resp = dynamodb_client.get_item(
+            TableName=TABLE_NAMES.blobs,
+            Key=dict(digest=dict(S=digest)),
+            ProjectionExpression="refcount",
+            ConsistentRead=True,
+        )
+        return int(resp.get("Item", {}).get("refcount", {}).get("N", "0"))
+
+    @staticmethod
+    def is_unreferenced(digest):
+        resp = dynamodb_client.query(
+            TableName=TABLE_NAMES.in_references,
+            KeyConditionExpression="digest = :digest",
+            ExpressionAttributeValues={":digest": dict(S=digest)},
+            Select="COUNT",
+            Limit=1,
+            # We must observe the in_refs we deleted a moment ago
+            ConsistentRead=True,
+        )
+        return resp["Count"] == 0
+
+    @staticmethod
+    def referrers(digest):
+        """Returns the manifests that reference a blob, as of now."""
+
+        kwargs = dict(
+            TableName=TABLE_NAMES.in_references,
+            KeyConditionExpression="digest = :digest",
+            ExpressionAttributeValues={":digest": dict(S=digest)},
+            ConsistentRead=True,
+        )
+        sources = []
+        for page in dynamodb_client.get_paginator("query").paginate(**kwargs):
+            sources.extend(item["source"]["S"] for item in page["Items"])
+
+        return sources
+
+    @staticmethod
+    def size_in_s3(digest):
+        """Returns the blob's size, or None if it isn't in S3."""
+
+        try:
+            resp = s3.head_object(Bucket=BUCKET_NAME, Key="blobs/" + digest)
         except botocore.exceptions.ClientError:
             # In general this will be a 404
             # It could be another type of error, but either way it means the data is
             # inaccessible
-            return False
+            return None
 
-        TABLES.blobs.put_item(Item=dict(digest=self._digest))
-        return True
+        return resp["ContentLength"]
+
+    @staticmethod
+    def mark_found(digest, size, media_type=None):
+        """Records a verified upload, without clobbering the blob's refcount.
+        Returns the blob's row as it was before."""
+
+        names = {"#found": "found", "#size": "size"}
+        values = {":true": dict(BOOL=True), ":size": dict(N=str(size))}
+        update = "SET #found = :true, #size = :size"
+        if media_type:
+            names["#media_type"] = "media_type"
+            values[":media_type"] = dict(S=media_type)
+            update += ", #media_type = :media_type"
+
+        resp = dynamodb_client.update_item(
+            TableName=TABLE_NAMES.blobs,
+            Key=dict(digest=dict(S=digest)),
+            UpdateExpression=update,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_OLD",
+        )
+        return unmarshal(resp.get("Attributes", {}))
+
+    @staticmethod
+    def mark_resolved(digest):
+        """Records that the references waiting on an upload have been resolved."""
+
+        dynamodb_client.update_item(
+            TableName=TABLE_NAMES.blobs,
+            Key=dict(digest=dict(S=digest)),
+            UpdateExpression="SET resolved = :true",
+            ExpressionAttributeValues={":true": dict(BOOL=True)},
+        )
+
+    @staticmethod
+    def _batch_get(keys):
+        """Looks up a single chunk of at most 100 keys, retrying unprocessed keys."""
 
-    @classmethod
-    def _batch_fetch_dynamodb(cls, digests):
         ret = []
-        for chunk in chunks(digests, 100):
-            resp = DYNAMODB.batch_get_item(
-                RequestItems={
-                    TABLE_NAMES.blobs: dict(
-                        Keys=[dict(digest=d) for d in digests],
-                        ProjectionExpression="digest",
-                    )
-                }
+        request = {
+            TABLE_NAMES.blobs: dict(
+                Keys=keys,
+                ProjectionExpression="digest, #found",
+                ExpressionAttributeNames={"#found": "found"},
             )
+        }
+        for attempt in range(BATCH_GET_ATTEMPTS):
+            if attempt:
+                backoff(attempt)
 
-            ret.extend(row["digest"] for row in resp["Responses"][TABLE_NAMES.blobs])
+            resp = dynamodb_client.batch_get_item(RequestItems=request)
+            for row in resp["Responses"].get(TABLE_NAMES.blobs, []):
+                # Rows are created by the first reference to a blob, which may
+                # not have been uploaded yet. Rows from before then are all found.
+                if row.get("found", dict(BOOL=True))["BOOL"]:
+                    ret.append(row["digest"]["S"])
 
-        return ret
+            request = resp.get("UnprocessedKeys")
+            if not request:
+                return ret
+
+        raise RuntimeError(f"Keys still unprocessed after {attempt + 1} attempts")
 
     @classmethod
-    def batch_exists(cls, digests):
-        exists = set(cls._batch_fetch_dynamodb(digests))
-        missing = set(digests) - exists
+    def _batch_fetch_dynamodb(cls, digests):
+        # BatchGetItem rejects requests containing duplicate keys
+        keys = [dict(digest=dict(S=d)) for d in set(digests)]
 
-        for digest in missing:
-            if cls(digest)._exists_in_s3():
-                exists.add(digest)
+        ret = []
+        for found in POOL.map(cls._batch_get, chunks(keys, 100)):
+            ret.extend(found)
 
-        return exists
+        return ret
+
+    @classmethod
+    def batch_exists(cls, digests):
+        # Blob rows are written when uploads are verified, so DynamoDB alone
+        # knows which blobs exist.
+        return set(cls._batch_fetch_dynamodb(digests))
 
 
 class Indexers:
@@ -105,40 +416,156 @@ class Indexers:
         "application/vnd.oci.image.manifest.v1+json": "manifest",
         "application/vnd.oci.image.config.v1+json": "image",
         "application/vnd.docker.container.image.v1+json": "image",
+        "application/vnd.docker.distribution.manifest.list.v2+json": "index",
+        "application/vnd.oci.image.index.v1+json": "index",
     }
 
     @staticmethod
-    def _manifest(body, name: str):
+    def _manifest(body, children, repo_name):
         digests = [body["config"]["digest"]]
         for layer in body["layers"]:
             digests.append(layer["digest"])
 
-        exists_set = Blob.batch_exists(digests)
-        items = [dict(digest=d, source=name) for d in digests]
+        return digests
+
+    @staticmethod
+    def _image(body, children, repo_name):
+        return []
+
+    @classmethod
+    def _index(cls, body, children, repo_name):
+        """A multi-platform image. Its child manifests are recorded in `children`
+        as they are fetched."""
+
+        child_digests = [child["digest"] for child in body["manifests"]]
+        fetched = POOL.map(fetch_child_manifest, child_digests, repeat(repo_name))
+
+        digests = list(child_digests)
+        for digest, found in zip(child_digests, fetched):
+            if found is None:
+                # Not uploaded yet. The edge is recorded with found=False.
+                continue
+
+            key, child_body = found
+            child = json.loads(child_body)
+            children[digest] = (child_body, child, key)
+            op = getattr(cls, "_" + cls.formats[child["mediaType"]])
+            digests.extend(op(child, children, repo_name))
+
+        return digests
+
+    @staticmethod
+    def link(name: str, digests):
+        """Brings the outbound references of `name` in line with `digests`, only
+        writing the edges that changed since it was last indexed."""
+
+        existing = {ref["digest"]: ref["found"] for ref in outbound_references(name)}
+        wanted = set(digests)
+        added = wanted - existing.keys()
+        removed = existing.keys() - wanted
+        unresolved = {d for d in wanted & existing.keys() if not existing[d]}
+
+        exists_set = Blob.batch_exists(added | unresolved)
 
         # Write in_refs, then out_refs
         # The happens-before relationship is why we don't use a GSI
         # This synchronizes with the delete routine.
 
-        with TABLES.in_references.batch_writer() as batch:
-            for item in items:
-                batch.put_item(item)
+        def add(digest):
+            Blob.add_reference(digest, name, found=digest in exists_set)
 
-        with TABLES.references.batch_writer() as batch:
-            for item in items:
-                batch.put_item(dict(found=item["digest"] in exists_set, **item))
+        list(POOL.map(add, added))
 
-        return digests
+        batch_write(
+            TABLE_NAMES.references,
+            [
+                dict(
+                    PutRequest=dict(
+                        Item=marshal(
+                            dict(digest=digest, source=name, found=digest in exists_set)
+                        )
+                    )
+                )
+                for digest in added | (unresolved & exists_set)
+            ],
+        )
 
-    @staticmethod
-    def _handle_image(body):
-        pass
+        ManifestHandlers.gc_references(name, removed)
 
     @classmethod
-    def index(cls, manifest, name: str):
+    def references(cls, manifest, children, repo_name):
+        """Returns the digests a manifest in `repo_name` references. Child
+        manifests found along the way are recorded in `children`, as a mapping
+        from digest to (body, parsed body, key)."""
+
         fmt = cls.formats[manifest["mediaType"]]
         op = getattr(cls, "_" + fmt)
-        return op(manifest, name)
+        return op(manifest, children, repo_name)
+
+
+def fetch_child_manifest(digest, repo_name):
+    """Returns the key and body of a child manifest of an image index, or None if
+    it is absent.
+
+    Children are content-addressed, so they are looked for as blobs, and then as
+    manifests pushed by digest, which is where the registry API puts them.
+    """
+
+    for key in ("blobs/" + digest, f"manifests/{repo_name}:{digest}"):
+        try:
+            body = s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read()
+        except s3.exceptions.NoSuchKey:
+            continue
+
+        if "sha256:" + sha256(body).hexdigest() == digest:
+            return key, body
+
+    return None
+
+
+def store_blob(digest, body, media_type):
+    """Stores a blob under its content address, unless it is already there."""
+
+    key = "blobs/" + digest
+    if Blob.size_in_s3(digest) is None:
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=body, ContentType=media_type)
+
+    # We know these bytes are good, so don't wait for the upload to be verified
+    Blob.mark_found(digest, len(body), media_type)
+    return key
+
+
+def describe_manifest(body, manifest):
+    """The attributes that let the read path serve a manifest from its item."""
+
+    item = dict(
+        digest="sha256:" + sha256(body).hexdigest(),
+        media_type=manifest["mediaType"],
+        size=len(body),
+    )
+    if len(body) <= MANIFEST_INLINE_LIMIT:
+        item["body"] = body
+
+    return item
+
+
+def outbound_references(name):
+    """Yields every outbound reference of a manifest."""
+
+    kwargs = dict(
+        TableName=TABLE_NAMES.references,
+        KeyConditionExpression="#source = :source",
+        ProjectionExpression="digest, #found",
+        ExpressionAttributeNames={"#found": "found", "#source": "source"},
+        ExpressionAttributeValues={":source": dict(S=name)},
+    )
+    while True:
+        resp = dynamodb_client.query(**kwargs)
+        yield from (unmarshal(item) for item in resp["Items"])
+
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
 
 
 def trim_start(s, prefix):
@@ -148,21 +575,147 @@ def trim_start(s, prefix):
     return s[len(prefix) :]
 
 
+class ClaimedError(RuntimeError):
+    """An earlier event holds the claim on a manifest name, until `until`."""
+
+    def __init__(self, image_name, until):
+        super().__init__(f"{image_name} is claimed by an earlier event")
+        self.until = until
+
+
+def _claimed_by(sequencer):
+    """A condition that only admits writes from the event holding the claim on a
+    manifests item. Writing an item without `claimed` releases the claim."""
+
+    return dict(
+        ConditionExpression="claimed = :seq",
+        ExpressionAttributeValues={":seq": dict(S=sequencer)},
+    )
+
+
 class ManifestHandlers:
     @staticmethod
-    def _handle_manifest_created(s3_object, image_name):
-        """A manifest (a GC root) was uploaded"""
+    def describe(body, image_name):
+        """Works out what indexing records for a manifest: its item, the items of
+        its digest aliases by name, and the digests it references."""
 
         repo_name = image_name.split(":")[0]
-        body = s3_object.get()["Body"].read()
         manifest = json.loads(body)
-        digest = "sha256:" + sha256(body).hexdigest()
 
-        Indexers.index(manifest, image_name)
+        item = describe_manifest(body, manifest)
+        children = dict()
+        references = Indexers.references(manifest, children, repo_name)
+
+        digests = []
+        if "body" not in item:
+            # Too big to inline, so store an immutable content-addressed copy for
+            # digest pulls. Referencing it from the tag keeps it alive until the
+            # tag moves on.
+            item["key"] = store_blob(item["digest"], body, item["media_type"])
+            digests.append(item["digest"])
+        digests.extend(references)
+
+        # Digest aliases let pulls by digest resolve with a single lookup,
+        # including `--platform` pulls of the children of an image index.
+        aliases = {f"{repo_name}:{item['digest']}": item}
+        for digest, (child_body, child, key) in children.items():
+            child_item = describe_manifest(child_body, child)
+            child_item["key"] = key
+            aliases[f"{repo_name}:{digest}"] = child_item
+
+        tag_item = dict(item, name=image_name, aliases=list(aliases))
+        tag = image_name[len(repo_name) + 1 :]
+        if not tag.startswith("sha256:"):
+            # Picked up by the tags index, which backs the tags/list endpoint
+            tag_item.update(repository=repo_name, tag=tag)
+        elif image_name in aliases:
+            # Uploaded under its own digest, so it is an owner of its alias: other
+            # tags with this digest going away mustn't take its item with them
+            tag_item["owners"] = {image_name}
+
+        return tag_item, aliases, digests
 
-        TABLES.manifests.put_item(Item=dict(name=image_name))
-        TABLES.manifests.put_item(
-            Item=dict(name=f"{repo_name}:{digest}", actual=image_name)
+    @classmethod
+    def _apply(cls, image_name, tag_item, aliases, digests, claim):
+        """Indexes a described manifest while `claim` holds its name, if not None.
+        Returns False if the claim ran out and a newer event took it over."""
+
+        # The previous version's aliases would outlive the references that keep
+        # their content alive, so they go before those are collected.
+        resp = dynamodb_client.get_item(
+            TableName=TABLE_NAMES.manifests,
+            Key=dict(name=dict(S=image_name)),
+            ProjectionExpression="aliases, digest",
+            ConsistentRead=True,
+        )
+        previous = unmarshal(resp.get("Item", {}))
+        cls._delete_aliases(
+            image_name, set(previous.get("aliases", [])) - aliases.keys()
+        )
+
+        if NAME_FILTER and "tag" in tag_item and "digest" not in previous:
+            # A new tag, which the published filter doesn't have yet. Recorded
+            # before it is indexed, so the read path never turns it away.
+            update_recent_names(lambda names: names.update({image_name: int(time())}))
+
+        Indexers.link(image_name, digests)
+
+        kwargs = _claimed_by(claim) if claim is not None else dict()
+        try:
+            dynamodb_client.put_item(
+                TableName=TABLE_NAMES.manifests, Item=marshal(tag_item), **kwargs
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        # A manifest uploaded under its digest is its own alias; the tag item
+        # already serves it
+        aliases = {a: item for a, item in aliases.items() if a != image_name}
+        list(POOL.map(cls.put_alias, aliases, aliases.values(), repeat({image_name})))
+        return True
+
+    @classmethod
+    def _handle_manifest_created(cls, s3_object, image_name, sequencer):
+        """A manifest (a GC root) was uploaded"""
+
+        repo_name = image_name.split(":")[0]
+        body = s3_object.get()["Body"].read()
+        try:
+            tag_item, aliases, digests = cls.describe(body, image_name)
+        except (ValueError, KeyError, TypeError) as e:
+            # Bad JSON or an unknown mediaType, which no retry can index. The tag
+            # no longer names what was indexed, so it is deindexed like a delete.
+            print(f"Not indexing {image_name}: {e!r}")
+            return cls._handle_manifest_deleted(s3_object, image_name, sequencer)
+
+        if sequencer is not None:
+            tag_item.update(sequencer=sequencer, version_id=s3_object.id)
+        if not cls._apply(image_name, tag_item, aliases, digests, sequencer):
+            # Our claim ran out and a newer event took it over
+            return
+
+        if Indexers.formats[tag_item["media_type"]] == "index":
+            # A child uploaded while this was being indexed can be missed both
+            # here and by the child's own event, which only sees finished indexes
+            aliased = {alias.split(":", 1)[1] for alias in aliases}
+            children = {c["digest"] for c in json.loads(body)["manifests"]}
+            missing = children - aliased
+            arrived = Blob.batch_exists(missing)
+            pushed = POOL.map(cls._pushed_by_digest, repeat(repo_name), missing)
+            arrived.update(d for d, p in zip(missing, pushed) if p)
+            for digest in arrived:
+                cls.relink(image_name, digest)
+
+        digest = image_name[len(repo_name) + 1 :]
+        if digest.startswith("sha256:"):
+            # Possibly the child of an image index pushed before it
+            for source in Blob.referrers(digest):
+                if source.startswith(repo_name + ":") and source != image_name:
+                    cls.relink(source, digest)
+
+        dynamodb_client.put_item(
+            TableName=TABLE_NAMES.repositories,
+            Item=marshal(dict(catalog=CATALOG, repository=repo_name)),
         )
 
         s3.put_object_tagging(
@@ -173,72 +726,234 @@ class ManifestHandlers:
         )
 
     @staticmethod
-    def _put_expires(image_name, *, already_exists: bool):
+    def put_alias(alias, alias_item, owners):
+        """Points a digest alias at the manifest it names, adding `owners` to the
+        tags that share it. The alias outlives all but the last of them."""
+
+        attributes = dict(alias_item, actual=min(owners))
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        values = {f":a{i}": value for i, value in enumerate(attributes.values())}
+        values[":owners"] = owners
+        dynamodb_client.update_item(
+            TableName=TABLE_NAMES.manifests,
+            Key=dict(name=dict(S=alias)),
+            UpdateExpression=(
+                "SET "
+                + ", ".join(f"#a{i} = :a{i}" for i in range(len(names)))
+                + " ADD owners :owners REMOVE expires"
+            ),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=marshal(values),
+        )
+
+    @staticmethod
+    def _pushed_by_digest(repo_name, digest):
+        try:
+            s3.head_object(Bucket=BUCKET_NAME, Key=f"manifests/{repo_name}:{digest}")
+        except botocore.exceptions.ClientError:
+            return False
+
+        return True
+
+    @staticmethod
+    def _put_expires(image_name, *, already_exists: bool, sequencer, version_id):
         # If any indexing attempts to complete (not initiate) they will fail in the
         # presence of this tombstone. Good!
         expires = int(time()) + 3600
+        item = dict(name=image_name, expires=expires)
 
         kwargs = dict()
-        if not already_exists:
+        if sequencer is not None:
+            item.update(sequencer=sequencer, version_id=version_id)
+            kwargs.update(_claimed_by(sequencer))
+        elif not already_exists:
             kwargs.update(
                 ConditionExpression="attribute_not_exists(#name)",
                 ExpressionAttributeNames={"#name": "name"},
             )
 
-        TABLES.manifests.put_item(
-            Item=dict(name=image_name, expires=expires),
-            **kwargs,
+        dynamodb_client.put_item(
+            TableName=TABLE_NAMES.manifests, Item=marshal(item), **kwargs
         )
 
     @staticmethod
-    def _gc_ref(digest, image_name):
-        """Garbage-collects a single reference to a blob, deleting the blob if its
-        refcount hits zero."""
-
-        TABLES.in_references.delete_item(Key=dict(digest=digest, source=image_name))
-
-        resp = TABLES.in_references.query(
-            KeyConditionExpression=Key("digest").eq(digest), Select="COUNT", Limit=1
+    def _gc_refs(image_name, digests):
+        """Garbage-collects references from one manifest to many blobs, deleting the
+        blobs whose refcount hits zero."""
+
+        # Delete in_refs, then out_refs: the reverse of the order the indexer
+        # writes them in.
+        def remove(digest):
+            return Blob.remove_reference(digest, image_name)
+
+        unreferenced = POOL.map(remove, digests)
+        Blob.batch_delete([d for d, u in zip(digests, unreferenced) if u])
+
+        batch_write(
+            TABLE_NAMES.references,
+            [
+                dict(
+                    DeleteRequest=dict(
+                        Key=dict(source=dict(S=image_name), digest=dict(S=digest))
+                    )
+                )
+                for digest in digests
+            ],
         )
-        if resp["Count"] == 0:
-            # The object is now unreferenced
-            Blob(digest).delete()
 
-        TABLES.references.delete_item(Key=dict(source=image_name, digest=digest))
+    @classmethod
+    def gc_references(cls, image_name, digests):
+        """Garbage collects some of the outbound references of a single manifest."""
+
+        for chunk in chunks(sorted(digests), 1000):
+            cls._gc_refs(image_name, chunk)
 
     @classmethod
     def _perform_gc(cls, image_name):
         """Garbage collects all of the outbound references of a single manifest."""
 
-        while True:
-            resp = TABLES.references.query(
-                KeyConditionExpression=Key("source").eq(image_name)
-            )
+        refs = outbound_references(image_name)
+        cls.gc_references(image_name, {ref["digest"] for ref in refs})
 
-            if resp["Count"] == 0:
-                break
+    @staticmethod
+    def _delete_aliases(image_name, aliases):
+        """Drops `image_name` from the owners of `aliases`, deleting those that no
+        other tag owns any more."""
+
+        for alias in aliases:
+            if alias == image_name:
+                # Uploaded under its own digest; its item is the tag's, not an alias
+                continue
+
+            try:
+                resp = dynamodb_client.update_item(
+                    TableName=TABLE_NAMES.manifests,
+                    Key=dict(name=dict(S=alias)),
+                    UpdateExpression="DELETE owners :owner",
+                    # Aliases written before owners were recorded name one tag
+                    ConditionExpression=(
+                        "contains(owners, :name) "
+                        "OR (attribute_not_exists(owners) AND actual = :name)"
+                    ),
+                    ExpressionAttributeValues={
+                        ":owner": dict(SS=[image_name]),
+                        ":name": dict(S=image_name),
+                    },
+                    ReturnValues="ALL_NEW",
+                )
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                # Already gone, or not this tag's
+                continue
+
+            if "owners" in resp["Attributes"]:
+                # Another live tag has the same digest
+                continue
+
+            try:
+                dynamodb_client.delete_item(
+                    TableName=TABLE_NAMES.manifests,
+                    Key=dict(name=dict(S=alias)),
+                    ConditionExpression="attribute_not_exists(owners)",
+                )
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                # Another tag with this digest was indexed in the meantime
+                pass
 
-            for item in resp["Items"]:
-                cls._gc_ref(item["digest"], image_name)
+    @staticmethod
+    def _forget_repository_if_empty(repo_name):
+        """Drops a repository from the catalog once its last tag is gone.
+
+        The tags index is only eventually consistent, so a tag pushed at the same
+        moment can be missed; the repository reappears on its next push.
+        """
+
+        resp = dynamodb_client.query(
+            TableName=TABLE_NAMES.manifests,
+            IndexName=TAGS_INDEX,
+            KeyConditionExpression="repository = :repository",
+            ExpressionAttributeValues={":repository": dict(S=repo_name)},
+            Select="COUNT",
+            Limit=1,
+        )
+        if resp["Count"] == 0:
+            dynamodb_client.delete_item(
+                TableName=TABLE_NAMES.repositories,
+                Key=dict(catalog=dict(S=CATALOG), repository=dict(S=repo_name)),
+            )
 
     @classmethod
-    def _handle_manifest_deleted(cls, s3_object, image_name):
+    def _handle_manifest_deleted(cls, s3_object, image_name, sequencer):
         """A manifest was deleted. Perform garbage collection."""
 
-        resp = TABLES.manifests.get_item(Key=dict(name=image_name))
-        item = resp.get("Item")
+        resp = dynamodb_client.get_item(
+            TableName=TABLE_NAMES.manifests,
+            Key=dict(name=dict(S=image_name)),
+            ConsistentRead=True,
+        )
+        item = unmarshal(resp["Item"]) if "Item" in resp else None
         if item:
             cls._perform_gc(image_name)
+            cls._delete_aliases(image_name, item.get("aliases", []))
+
+        # If this fails, a create happened during this delete, or our claim ran
+        # out and a newer event took it over
+        cls._put_expires(
+            image_name,
+            already_exists=bool(item),
+            sequencer=sequencer,
+            version_id=s3_object.id,
+        )
 
-        # If this fails, a create happened during this delete
-        cls._put_expires(image_name, already_exists=bool(item))
+        # Unlike uploads, deletions aren't tagged as done: the event's version is
+        # a delete marker, and S3 refuses to tag those.
+        cls._forget_repository_if_empty(image_name.split(":")[0])
 
-        s3.put_object_tagging(
-            Bucket=s3_object.bucket_name,
-            Key=s3_object.object_key,
-            VersionId=s3_object.id,
-            Tagging=dict(TagSet=[dict(Key="deindexed", Value=str(int(time())))]),
+    @classmethod
+    def relink(cls, image_name, child_digest):
+        """Indexes an image index again once one of its child manifests arrives.
+
+        A child uploaded after its index couldn't be read when the index was
+        indexed, so its config and layers weren't referenced and it got no digest
+        alias. Does nothing unless `image_name` is an index with that child, and
+        the child's alias is still missing.
+        """
+
+        resp = dynamodb_client.get_item(
+            TableName=TABLE_NAMES.manifests,
+            Key=dict(name=dict(S=image_name)),
+            ConsistentRead=True,
         )
+        item = unmarshal(resp.get("Item", {}))
+        repo_name = image_name.split(":")[0]
+        if (
+            "expires" in item
+            or Indexers.formats.get(item.get("media_type")) != "index"
+            or f"{repo_name}:{child_digest}" in item.get("aliases", [])
+        ):
+            return
+
+        if "body" in item:
+            body = item["body"].value
+        else:
+            body = s3.get_object(Bucket=BUCKET_NAME, Key=item["key"])["Body"].read()
+        if child_digest not in {c["digest"] for c in json.loads(body)["manifests"]}:
+            return
+
+        # Indexing again under the claim of the event that was last applied keeps
+        # out newer events, which would otherwise be undone.
+        claim = item.get("sequencer", "")
+        if not cls._reclaim(image_name, claim):
+            raise RuntimeError(f"{image_name} is claimed by another event")
+
+        try:
+            tag_item, aliases, digests = cls.describe(body, image_name)
+            for key in ("sequencer", "version_id"):
+                if key in item:
+                    tag_item[key] = item[key]
+            cls._apply(image_name, tag_item, aliases, digests, claim)
+        except Exception:
+            cls._release(image_name, claim)
+            raise
 
     @classmethod
     def _determine_op(cls, event_type):
@@ -250,35 +965,461 @@ class ManifestHandlers:
 
         return None
 
+    @staticmethod
+    def _claim(image_name, sequencer):
+        """Claims a manifest name for an event, so that no other event for it can
+        link or garbage-collect references until this one is applied.
+
+        Returns False if the event is stale: an event at or after it was already
+        applied, or has claimed the name. Raises ClaimedError if an earlier event
+        holds the claim, so that this one is retried once it is done.
+        """
+
+        now = int(time())
+        key = dict(name=dict(S=image_name))
+        names = {"#name": "name"}
+        try:
+            dynamodb_client.update_item(
+                TableName=TABLE_NAMES.manifests,
+                Key=key,
+                UpdateExpression="SET claimed = :seq, claimed_until = :until",
+                ConditionExpression=(
+                    "attribute_exists(#name) "
+                    "AND (attribute_not_exists(sequencer) OR sequencer < :seq) "
+                    "AND (attribute_not_exists(claimed) OR claimed = :seq "
+                    "OR claimed_until < :now)"
+                ),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    ":seq": dict(S=sequencer),
+                    ":until": dict(N=str(now + CLAIM_SECONDS)),
+                    ":now": dict(N=str(now)),
+                },
+            )
+            return True
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+
+        resp = dynamodb_client.get_item(
+            TableName=TABLE_NAMES.manifests, Key=key, ConsistentRead=True
+        )
+        if "Item" not in resp:
+            # Never indexed, so claim it with a tombstone the read path ignores
+            item = dict(
+                name=image_name,
+                expires=now + 3600,
+                claimed=sequencer,
+                claimed_until=now + CLAIM_SECONDS,
+            )
+            try:
+                dynamodb_client.put_item(
+                    TableName=TABLE_NAMES.manifests,
+                    Item=marshal(item),
+                    ConditionExpression="attribute_not_exists(#name)",
+                    ExpressionAttributeNames=names,
+                )
+                return True
+            except dynamodb_client.exceptions.ConditionalCheckFailedException:
+                # Another event got there first; looking again will tell which
+                raise ClaimedError(image_name, now)
+
+        item = unmarshal(resp["Item"])
+        if (
+            item.get("sequencer", "") >= sequencer
+            or item.get("claimed", "") > sequencer
+        ):
+            return False
+
+        raise ClaimedError(image_name, int(item.get("claimed_until", now)))
+
     @classmethod
-    def handle(cls, event_type, s3_object, image_name):
+    def _wait_for_claim(cls, image_name, sequencer):
+        """Claims a manifest name, waiting a little for an earlier event to finish
+        with it. Returns False if the event is stale."""
+
+        for attempt in range(CLAIM_ATTEMPTS):
+            if attempt:
+                backoff(attempt)
+
+            try:
+                return cls._claim(image_name, sequencer)
+            except ClaimedError as e:
+                error = e
+
+        raise error
+
+    @staticmethod
+    def _reclaim(image_name, sequencer):
+        """Claims a manifest name again for the event that was last applied to it,
+        or with an empty sequencer if it was indexed without one. Returns False if
+        another event has since been applied or holds the claim."""
+
+        now = int(time())
+        if sequencer:
+            applied = "sequencer = :seq"
+        else:
+            applied = "attribute_not_exists(sequencer)"
+        try:
+            dynamodb_client.update_item(
+                TableName=TABLE_NAMES.manifests,
+                Key=dict(name=dict(S=image_name)),
+                UpdateExpression="SET claimed = :seq, claimed_until = :until",
+                ConditionExpression=(
+                    f"attribute_exists(#name) AND {applied} "
+                    "AND (attribute_not_exists(claimed) OR claimed_until < :now)"
+                ),
+                ExpressionAttributeNames={"#name": "name"},
+                ExpressionAttributeValues={
+                    ":seq": dict(S=sequencer),
+                    ":until": dict(N=str(now + CLAIM_SECONDS)),
+                    ":now": dict(N=str(now)),
+                },
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    @staticmethod
+    def _release(image_name, sequencer):
+        """Gives up an event's claim on a manifest name, unless it was taken over."""
+
+        try:
+            dynamodb_client.update_item(
+                TableName=TABLE_NAMES.manifests,
+                Key=dict(name=dict(S=image_name)),
+                UpdateExpression="REMOVE claimed, claimed_until",
+                **_claimed_by(sequencer),
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    @classmethod
+    def handle(cls, event_type, s3_object, image_name, sequencer=None):
         op = cls._determine_op(event_type)
-        if op:
-            return op(s3_object, image_name)
+        if not op:
+            return
 
+        # S3 delivers at least once and out of order. Skip duplicates and events
+        # older than what we've indexed before doing any of the expensive work,
+        # and keep events for the same name from indexing it at the same time.
+        if sequencer is not None and not cls._wait_for_claim(image_name, sequencer):
+            return
 
-def handle_record(r):
-    if r["eventSource"] != "aws:s3":
-        return
+        try:
+            return op(s3_object, image_name, sequencer)
+        except Exception:
+            # Otherwise no event for this name could be applied, including this
+            # one's retries, until the claim ran out
+            if sequencer is not None:
+                cls._release(image_name, sequencer)
+            raise
+
+
+class BlobHandlers:
+    @staticmethod
+    def _hash(s3_object, size):
+        """Hashes an object by streaming it in ranged GETs issued in parallel.
+
+        At most VERIFY_RANGES ranges are in flight or buffered at once, so memory
+        use doesn't grow with the size of the layer.
+        """
+
+        def fetch(start):
+            end = min(start + VERIFY_RANGE_SIZE, size) - 1
+            resp = s3.get_object(
+                Bucket=s3_object.bucket_name,
+                Key=s3_object.object_key,
+                VersionId=s3_object.id,
+                Range=f"bytes={start}-{end}",
+            )
+            return resp["Body"].read()
+
+        h = sha256()
+        starts = iter(range(0, size, VERIFY_RANGE_SIZE))
+        pending = deque(
+            POOL.submit(fetch, start) for start in islice(starts, VERIFY_RANGES)
+        )
+        while pending:
+            h.update(pending.popleft().result())
+            if (start := next(starts, None)) is not None:
+                pending.append(POOL.submit(fetch, start))
+
+        return "sha256:" + h.hexdigest()
+
+    @staticmethod
+    def _resolve(digest, source):
+        try:
+            dynamodb_client.update_item(
+                TableName=TABLE_NAMES.references,
+                Key=dict(source=dict(S=source), digest=dict(S=digest)),
+                UpdateExpression="SET #found = :true",
+                ConditionExpression="attribute_exists(digest)",
+                ExpressionAttributeNames={"#found": "found"},
+                ExpressionAttributeValues={":true": dict(BOOL=True)},
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            # The reference was garbage collected in the meantime
+            pass
+
+    @classmethod
+    def _handle_blob_created(cls, s3_object, digest):
+        """A blob was uploaded. Check it is what it claims to be and record it."""
+
+        head = s3.head_object(
+            Bucket=s3_object.bucket_name,
+            Key=s3_object.object_key,
+            VersionId=s3_object.id,
+        )
+        size = head["ContentLength"]
+
+        # Only sha256 is verified. Digests in other algorithms are recorded as
+        # uploaded, and left for clients to verify.
+        if digest.startswith("sha256:") and cls._hash(s3_object, size) != digest:
+            # Clients verify digests, so these bytes could never be pulled
+            # successfully. Remove this version rather than serve it.
+            s3.delete_object(
+                Bucket=s3_object.bucket_name,
+                Key=s3_object.object_key,
+                VersionId=s3_object.id,
+            )
+            return
+
+        if Blob.mark_found(digest, size, head.get("ContentType")).get("resolved"):
+            # Uploaded again. Nothing has waited on it since it first arrived.
+            return
+
+        # Manifests uploaded before this blob referenced it with found=False.
+        # Either this sees an index's in_ref, or the index sees mark_found.
+        sources = Blob.referrers(digest)
+        list(POOL.map(cls._resolve, [digest] * len(sources), sources))
+
+        # A child manifest of an image index has references and an alias of its
+        # own, which couldn't be recorded while it was missing
+        for source in sources:
+            ManifestHandlers.relink(source, digest)
+
+        # Only now, so that a retry after a failure above does all of it again
+        Blob.mark_resolved(digest)
+
+    @classmethod
+    def handle(cls, event_type, s3_object, digest):
+        if event_type.startswith("ObjectCreated:"):
+            return cls._handle_blob_created(s3_object, digest)
+
+
+def _object_key(r):
+    """Returns the key a record is about, or None if we don't index it."""
+
+    if r.get("eventSource") != "aws:s3":
+        return None
 
     s3_info = r["s3"]
     bucket = s3_info["bucket"]["name"]
-    if bucket != BUCKET.name:
+    if bucket != BUCKET_NAME:
         # We got sent a notification for the wrong bucket!?
-        return
+        return None
+
+    key = unquote_plus(s3_info["object"]["key"], encoding="utf-8")
+    if not key.startswith(("manifests/", "blobs/")):
+        return None
+
+    return key
 
-    object_info = s3_info["object"]
-    key = unquote_plus(object_info["key"], encoding="utf-8")
-    image_name = trim_start(key, "manifests/")
 
-    if not image_name:
-        # We got a notification about something other than a manifest
+def _sequencer(r):
+    """Returns the record's S3 sequencer in a form that sorts by event order."""
+
+    sequencer = r["s3"]["object"].get("sequencer")
+    if sequencer is None:
+        return None
+
+    # Sequencers may differ in length and are compared after left-padding with
+    # zeros. Padding them all to one width lets DynamoDB compare them as strings.
+    return format(int(sequencer, 16), "032X")
+
+
+def handle_record(r):
+    key = _object_key(r)
+    if not key:
         return
 
-    s3_object = ObjectVersion(bucket, key, object_info["versionId"])
-    ManifestHandlers.handle(r["eventName"], s3_object, image_name)
+    s3_object = ObjectVersion(BUCKET_NAME, key, r["s3"]["object"]["versionId"])
+    if image_name := trim_start(key, "manifests/"):
+        ManifestHandlers.handle(r["eventName"], s3_object, image_name, _sequencer(r))
+    elif digest := trim_start(key, "blobs/"):
+        BlobHandlers.handle(r["eventName"], s3_object, digest)
 
 
-def lambda_handler(event, context):
+def _s3_records(event):
+    """Yields (record, SQS message) pairs. Notifications delivered through SQS
+    carry the S3 event in the message body; direct invocations have no message."""
+
     for r in event["Records"]:
-        handle_record(r)
+        if r.get("eventSource") == "aws:sqs":
+            for inner in json.loads(r["body"]).get("Records", []):
+                yield inner, r
+        else:
+            yield r, None
+
+
+def _coalesce(event):
+    """Groups records by object key, in sequencer order."""
+
+    groups = defaultdict(list)
+    for r, message in _s3_records(event):
+        if key := _object_key(r):
+            groups[key].append((r, message))
+
+    for records in groups.values():
+        records.sort(key=lambda pair: _sequencer(pair[0]) or "")
+
+    return groups
+
+
+@cache
+def _queue_url(queue_arn):
+    _, _, _, _, account, name = queue_arn.split(":")
+    return sqs_client().get_queue_url(QueueName=name, QueueOwnerAWSAccountId=account)[
+        "QueueUrl"
+    ]
+
+
+def _retry_later(message, until):
+    """Has SQS redeliver a message held up by a claim sooner than the queue's
+    visibility timeout would, but not before the claim runs out."""
+
+    receives = int(message.get("attributes", {}).get("ApproximateReceiveCount", 1))
+    delay = CLAIM_RETRY_DELAY * 2 ** (receives - 1)
+    sqs_client().change_message_visibility(
+        QueueUrl=_queue_url(message["eventSourceARN"]),
+        ReceiptHandle=message["receiptHandle"],
+        VisibilityTimeout=max(1, min(delay, until - int(time()))),
+    )
+
+
+def update_recent_names(update):
+    """Applies `update` to the mapping of recently created tags to the times they
+    were created, retrying if another invocation changes it at the same time."""
+
+    for attempt in range(RECENT_NAMES_ATTEMPTS):
+        if attempt:
+            backoff(attempt)
+
+        try:
+            resp = s3.get_object(Bucket=BUCKET_NAME, Key=RECENT_NAMES_KEY)
+            names = json.load(resp["Body"])
+            condition = dict(IfMatch=resp["ETag"])
+        except s3.exceptions.NoSuchKey:
+            names = dict()
+            condition = dict(IfNoneMatch="*")
+
+        update(names)
+        try:
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=RECENT_NAMES_KEY,
+                Body=json.dumps(names).encode(),
+                **condition,
+            )
+            return
+        except botocore.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+
+    raise RuntimeError(f"Recent names still contended after {attempt + 1} attempts")
+
+
+def publish_name_filter():
+    """Publishes a Bloom filter of every tag name to the bucket.
+
+    Tag names are read from the keys-only tags index, which is much cheaper to
+    scan than the manifests table with its inline bodies.
+    """
+
+    table = dynamodb_client.describe_table(TableName=TABLE_NAMES.manifests)["Table"]
+    indexes = {i["IndexName"]: i for i in table.get("GlobalSecondaryIndexes", [])}
+    # ItemCount lags by hours, so leave plenty of headroom
+    capacity = 2 * indexes[TAGS_INDEX]["ItemCount"] + 1024
+
+    names = BloomFilter.for_capacity(capacity, generation=int(time()))
+    pages = dynamodb_client.get_paginator("scan").paginate(
+        TableName=TABLE_NAMES.manifests,
+        IndexName=TAGS_INDEX,
+        ProjectionExpression="#name",
+        ExpressionAttributeNames={"#name": "name"},
+    )
+    for page in pages:
+        for item in page["Items"]:
+            names.add(item["name"]["S"])
+
+    s3.put_object(Bucket=BUCKET_NAME, Key=NAME_FILTER_KEY, Body=names.dumps())
+
+    # A tag is recorded as recent before it is indexed, and its invocation may
+    # have run for up to CLAIM_SECONDS before the scan started
+    covered = names.generation - CLAIM_SECONDS
+
+    def prune(recent):
+        for name, created in list(recent.items()):
+            if created < covered:
+                del recent[name]
+
+    update_recent_names(prune)
+
+
+def lambda_handler(event, context):
+    try:
+        with profiled(PROFILE_SAMPLE_RATE):
+            return _handle(event)
+    finally:
+        METRICS.flush()
+
+
+def _handle(event):
+    if event.get("source") == "aws.events":
+        # The periodic schedule, rather than an S3 notification
+        return publish_name_filter()
+
+    # Only the latest event for each key matters: it alone determines whether
+    # a manifest ends up indexed or deleted, and indexing reconciles against
+    # whatever was indexed before.
+    groups = _coalesce(event)
+    futures = [
+        (RECORD_POOL.submit(handle_record, records[-1][0]), records)
+        for records in groups.values()
+    ]
+
+    # Failed messages by id, which is None for direct invocations by S3
+    failed = dict()
+    # When the claims holding up failed messages run out, by message id
+    held = defaultdict(int)
+    errors = []
+    for future, records in futures:
+        try:
+            future.result()
+        except Exception as e:
+            claimed = isinstance(e, ClaimedError)
+            if claimed:
+                print(e)
+            else:
+                print_exc()
+            errors.append(e)
+            for _, message in records:
+                message_id = message["messageId"] if message else None
+                failed[message_id] = message
+                if claimed and message_id:
+                    held[message_id] = max(held[message_id], e.until)
+
+    if None in failed:
+        # Invoked directly by S3, which can only retry the entire event
+        raise errors[0]
+
+    for message_id, until in held.items():
+        try:
+            _retry_later(failed[message_id], until)
+        except Exception:
+            # It is then retried after the queue's visibility timeout
+            print_exc()
+
+    return dict(batchItemFailures=[dict(itemIdentifier=m) for m in sorted(failed)])
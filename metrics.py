@@ -0,0 +1,184 @@
+"""Per-invocation AWS call metrics, logged in CloudWatch Embedded Metric Format.
+
+Clients are instrumented through botocore's event hooks, so every call is
+timed, including those made by paginators, and DynamoDB calls report the
+capacity they consumed. Metrics accumulate across the threads of a process
+until `flush`, which the functions call at the end of each invocation.
+"""
+import cProfile
+import json
+import pstats
+from collections import defaultdict
+from contextlib import contextmanager
+from io import StringIO
+from random import random
+from random import sample
+from threading import Lock
+from time import perf_counter
+from time import time
+
+NAMESPACE = "ServerlessRegistry"
+
+# EMF caps the number of values a metric may carry in one log line
+MAX_VALUES = 100
+
+# DynamoDB operations that accept ReturnConsumedCapacity
+CAPACITY_OPERATIONS = {
+    "BatchGetItem",
+    "BatchWriteItem",
+    "DeleteItem",
+    "GetItem",
+    "PutItem",
+    "Query",
+    "Scan",
+    "TransactGetItems",
+    "TransactWriteItems",
+    "UpdateItem",
+}
+
+
+def _capacity_units(consumed):
+    # A single operation reports a dict; batches and transactions, one per table
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+
+    return sum(c.get("CapacityUnits", 0) for c in consumed)
+
+
+class Metrics:
+    def __init__(self, function_name):
+        self._function_name = function_name
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        self._latencies = defaultdict(list)
+        self._totals = defaultdict(float)
+
+    def instrument(self, client):
+        """Registers the hooks that record `client`'s calls. Returns the client."""
+
+        events = client.meta.events
+        events.register("before-call", self._before_call)
+        events.register("after-call", self._after_call)
+        events.register("after-call-error", self._after_call_error)
+        if client.meta.service_model.service_name == "dynamodb":
+            events.register("provide-client-params.dynamodb", self._ask_for_capacity)
+        return client
+
+    @staticmethod
+    def _ask_for_capacity(params, model, **kwargs):
+        if model.name in CAPACITY_OPERATIONS:
+            params.setdefault("ReturnConsumedCapacity", "TOTAL")
+
+    @staticmethod
+    def _before_call(context, **kwargs):
+        context["metrics_started"] = perf_counter()
+
+    def _finish_call(self, event_name, context, parsed):
+        elapsed = (perf_counter() - context.pop("metrics_started")) * 1000
+        # event_name looks like "after-call.dynamodb.GetItem"
+        operation = event_name.split(".", 1)[1]
+
+        with self._lock:
+            self._latencies[operation].append(elapsed)
+            self._totals["AWSCalls"] += 1
+            if parsed is None or "Error" in parsed:
+                self._totals["AWSErrors"] += 1
+                return
+
+            retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            self._totals["AWSRetries"] += retries
+            if consumed := parsed.get("ConsumedCapacity"):
+                self._totals["ConsumedCapacity"] += _capacity_units(consumed)
+
+    def _after_call(self, event_name, parsed, context, **kwargs):
+        self._finish_call(event_name, context, parsed)
+
+    def _after_call_error(self, event_name, context, **kwargs):
+        # Raised without a response, e.g. on connection errors
+        self._finish_call(event_name, context, None)
+
+    def count(self, name, value=1):
+        """Adds to a count that isn't about AWS calls, such as cache hits."""
+
+        with self._lock:
+            self._totals[name] += value
+
+    @contextmanager
+    def timed(self, name):
+        """Records the time spent in a block that isn't an AWS call."""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (perf_counter() - start) * 1000
+            with self._lock:
+                self._latencies[name].append(elapsed)
+
+    def flush(self):
+        """Logs everything recorded since the last flush as one EMF line."""
+
+        with self._lock:
+            latencies, totals = self._latencies, self._totals
+            self._reset()
+
+        if not latencies and not totals:
+            return
+
+        record = {"Function": self._function_name}
+        definitions = []
+        for name, values in sorted(latencies.items()):
+            record[f"{name}.Calls"] = len(values)
+            # Sampled down when over the cap; the call count stays exact
+            if len(values) > MAX_VALUES:
+                values = sample(values, MAX_VALUES)
+            record[f"{name}.Latency"] = [round(v, 3) for v in values]
+            definitions.append(dict(Name=f"{name}.Calls", Unit="Count"))
+            definitions.append(dict(Name=f"{name}.Latency", Unit="Milliseconds"))
+
+        for name, total in sorted(totals.items()):
+            record[name] = total
+            definitions.append(dict(Name=name, Unit="Count"))
+
+        record["_aws"] = dict(
+            Timestamp=int(time() * 1000),
+            CloudWatchMetrics=[
+                dict(
+                    Namespace=NAMESPACE,
+                    Dimensions=[["Function"]],
+                    Metrics=definitions,
+                )
+            ],
+        )
+        print(json.dumps(record))
+
+
+@contextmanager
+def profiled(sample_rate, limit=40):
+    """Profiles a sample of the blocks run under it, logging the hottest calls.
+
+    Only the calling thread is profiled, not work it hands to thread pools.
+    """
+
+    if sample_rate <= 0 or random() >= sample_rate:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another thread is already being profiled
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(limit)
+        print(out.getvalue())
@@ -2,10 +2,12 @@
 import json
 
 import pulumi_aws as aws
+from pulumi_aws import cloudwatch
 from pulumi_aws import dynamodb
 from pulumi_aws import iam
 from pulumi_aws import lambda_
 from pulumi_aws import s3
+from pulumi_aws import sqs
 
 import pulumi
 from pulumi import Output
@@ -27,6 +29,18 @@ def _make_config_ini(d):
     return pulumi.StringAsset(config_string)
 
 
+# Optional: a registry to pull misses through from, e.g. https://registry-1.docker.io
+UPSTREAM = pulumi.Config().get("upstream")
+# Optional: turn away unknown names with a filter of known ones, which the
+# indexer republishes every 5 minutes by scanning the tags index
+NAME_FILTER = pulumi.Config().get_bool("name_filter") or False
+# Optional: token authentication. auth_jwks is a local path to the token
+# server's JWKS, which is packaged with the read path.
+AUTH_CONFIG = {
+    key: pulumi.Config().get(key)
+    for key in ("auth_jwks", "auth_realm", "auth_service", "auth_issuer")
+}
+
 current = aws.get_caller_identity()
 account_id = current.account_id
 region = aws.get_region().name
@@ -136,9 +150,41 @@ TABLES = dict(
                     name="name",
                     type="S",
                 ),
+                dynamodb.TableAttributeArgs(
+                    name="repository",
+                    type="S",
+                ),
+                dynamodb.TableAttributeArgs(
+                    name="tag",
+                    type="S",
+                ),
             ],
             hash_key="name",
             billing_mode="PAY_PER_REQUEST",
+            global_secondary_indexes=[
+                dynamodb.TableGlobalSecondaryIndexArgs(
+                    name="tags",
+                    hash_key="repository",
+                    range_key="tag",
+                    projection_type="KEYS_ONLY",
+                ),
+            ],
+        ),
+        _table(
+            "repositories",
+            attributes=[
+                dynamodb.TableAttributeArgs(
+                    name="catalog",
+                    type="S",
+                ),
+                dynamodb.TableAttributeArgs(
+                    name="repository",
+                    type="S",
+                ),
+            ],
+            hash_key="catalog",
+            range_key="repository",
+            billing_mode="PAY_PER_REQUEST",
         ),
         _table(
             "blobs",
@@ -195,7 +241,7 @@ def lambda_iam_role(identifier, stmts):
     )
 
 
-def registry_iam_role(bucket_arn):
+def registry_iam_role(bucket_arn, queue_arn):
     return lambda_iam_role(
         "registry_s3_events",
         stmts=[
@@ -205,6 +251,8 @@ def registry_iam_role(bucket_arn):
                     "s3:GetObject",
                     "s3:GetObjectVersion",
                     "s3:DeleteObject",
+                    "s3:DeleteObjectVersion",
+                    "s3:PutObject",
                     "s3:PutObjectVersionTagging",
                     "s3:ListBucket",
                 ],
@@ -219,27 +267,82 @@ def registry_iam_role(bucket_arn):
                     "dynamodb:BatchGetItem",
                     "dynamodb:BatchWriteItem",
                     "dynamodb:DeleteItem",
+                    "dynamodb:DescribeTable",
                     "dynamodb:GetItem",
                     "dynamodb:PutItem",
                     "dynamodb:Query",
+                    "dynamodb:Scan",
+                    "dynamodb:UpdateItem",
                 ],
                 Resource=[
                     f"arn:aws:dynamodb:{region}:{account_id}:table/registry_*",
+                    f"arn:aws:dynamodb:{region}:{account_id}:table/registry_*/index/*",
+                ],
+            ),
+            dict(
+                Effect="Allow",
+                Action=[
+                    "sqs:ChangeMessageVisibility",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueAttributes",
+                    "sqs:GetQueueUrl",
+                    "sqs:ReceiveMessage",
                 ],
+                Resource=[queue_arn],
             ),
         ],
     )
 
 
-role = bucket.arn.apply(registry_iam_role)
+# S3 notifications are queued so that the indexer receives them in batches. It
+# coalesces the events for each key and reports failures per message.
+dead_letters = sqs.Queue(
+    "registry_s3_events_dlq", message_retention_seconds=14 * 24 * 3600
+)
+events_queue = sqs.Queue(
+    "registry_s3_events",
+    # No shorter than the indexer's timeout, or messages are redelivered while
+    # they are still being handled
+    visibility_timeout_seconds=900,
+    redrive_policy=dead_letters.arn.apply(
+        lambda arn: json.dumps(dict(deadLetterTargetArn=arn, maxReceiveCount=5))
+    ),
+)
+role = Output.all(bucket.arn, events_queue.arn).apply(
+    lambda arns: registry_iam_role(*arns)
+)
+
+
+def _queue_policy(queue_arn, bucket_arn):
+    return json.dumps(
+        dict(
+            Version="2012-10-17",
+            Statement=[
+                dict(
+                    Effect="Allow",
+                    Principal=dict(Service="s3.amazonaws.com"),
+                    Action="sqs:SendMessage",
+                    Resource=queue_arn,
+                    Condition=dict(
+                        ArnEquals={"aws:SourceArn": bucket_arn},
+                        StringEquals={"aws:SourceAccount": account_id},
+                    ),
+                )
+            ],
+        )
+    )
 
 
 def s3_lambda():
+    # With the filter on, the indexer also lists the tags it creates in between
+    options = dict(name_filter="true") if NAME_FILTER else dict()
     archive = Output.all(bucket=bucket.bucket, **TABLE_NAMES).apply(
         lambda names: pulumi.AssetArchive(
             {
-                "config.ini": _make_config_ini(names),
+                "config.ini": _make_config_ini(dict(names, **options)),
                 "lambda_function.py": pulumi.FileAsset("../lambda.py"),
+                "bloom.py": pulumi.FileAsset("../bloom.py"),
+                "metrics.py": pulumi.FileAsset("../metrics.py"),
             }
         )
     )
@@ -251,34 +354,63 @@ def s3_lambda():
         architectures=["x86_64"],
         runtime="python3.9",
         handler="lambda_function.lambda_handler",
+        # Verifying large layers takes a while
+        memory_size=1024,
+        timeout=900,
     )
 
-    lambda_perm = lambda_.Permission(
-        "s3",
-        action="lambda:InvokeFunction",
-        function=s3_events_function.name,
-        principal="s3.amazonaws.com",
-        source_account=current.account_id,
-        source_arn=bucket.arn,
+    lambda_.EventSourceMapping(
+        "registry_s3_events",
+        event_source_arn=events_queue.arn,
+        function_name=s3_events_function.name,
+        batch_size=25,
+        maximum_batching_window_in_seconds=5,
+        function_response_types=["ReportBatchItemFailures"],
     )
 
-    s3_events_function.name.apply(
-        lambda function_name: s3.BucketNotification(
-            "registry",
-            pulumi.ResourceOptions(depends_on=[lambda_perm]),
-            bucket=bucket.bucket,
-            lambda_functions=[
-                s3.BucketNotificationLambdaFunctionArgs(
-                    lambda_function_arn=f"arn:aws:lambda:{region}:{account_id}:function:"
-                    + function_name,
-                    events=[
-                        "s3:ObjectCreated:*",
-                        "s3:ObjectRemoved:DeleteMarkerCreated",
-                    ],
-                    filter_prefix="manifests/",
-                )
-            ],
+    if NAME_FILTER:
+        # Periodically publishes the filter of known manifest names
+        schedule = cloudwatch.EventRule(
+            "registry_name_filter", schedule_expression="rate(5 minutes)"
         )
+        cloudwatch.EventTarget(
+            "registry_name_filter", rule=schedule.name, arn=s3_events_function.arn
+        )
+        lambda_.Permission(
+            "schedule",
+            action="lambda:InvokeFunction",
+            function=s3_events_function.name,
+            principal="events.amazonaws.com",
+            source_arn=schedule.arn,
+        )
+
+    queue_policy = sqs.QueuePolicy(
+        "registry_s3_events",
+        queue_url=events_queue.id,
+        policy=Output.all(events_queue.arn, bucket.arn).apply(
+            lambda arns: _queue_policy(*arns)
+        ),
+    )
+
+    s3.BucketNotification(
+        "registry",
+        pulumi.ResourceOptions(depends_on=[queue_policy]),
+        bucket=bucket.bucket,
+        queues=[
+            s3.BucketNotificationQueueArgs(
+                queue_arn=events_queue.arn,
+                events=[
+                    "s3:ObjectCreated:*",
+                    "s3:ObjectRemoved:DeleteMarkerCreated",
+                ],
+                filter_prefix="manifests/",
+            ),
+            s3.BucketNotificationQueueArgs(
+                queue_arn=events_queue.arn,
+                events=["s3:ObjectCreated:*"],
+                filter_prefix="blobs/",
+            ),
+        ],
     )
 
 
@@ -291,28 +423,54 @@ def registry_server(config):
     bucket_name = config["bucket"]
     config["debug"] = "true"
 
-    archive = pulumi.AssetArchive(
-        {
-            "config.ini": _make_config_ini(config),
-            "lambda_function.py": pulumi.FileAsset("../app.py"),
-        }
-    )
-
-    role = lambda_iam_role(
-        identifier,
-        [
-            dict(
-                Effect="Allow",
-                Action="s3:GetObject",
-                Resource=[_s3_bucket_arn(bucket_name) + "/*"],
-            ),
+    statements = [
+        dict(
+            Effect="Allow",
+            Action="s3:GetObject",
+            Resource=[_s3_bucket_arn(bucket_name) + "/*"],
+        ),
+        dict(
+            Effect="Allow",
+            Action=["dynamodb:BatchGetItem", "dynamodb:GetItem", "dynamodb:Query"],
+            Resource=[
+                f"arn:aws:dynamodb:{region}:{account_id}:table/registry_*",
+                f"arn:aws:dynamodb:{region}:{account_id}:table/registry_*/index/*",
+            ],
+        ),
+    ]
+    function_kwargs = dict()
+    if NAME_FILTER:
+        config["name_filter"] = "true"
+    if UPSTREAM:
+        config["upstream"] = UPSTREAM
+        # Pulled-through manifests and blobs are written for the indexer
+        statements.append(
             dict(
                 Effect="Allow",
-                Action=["dynamodb:BatchGetItem", "dynamodb:GetItem"],
-                Resource=f"arn:aws:dynamodb:{region}:{account_id}:table/registry_*",
-            ),
-        ],
-    )
+                Action=["s3:PutObject", "s3:AbortMultipartUpload"],
+                Resource=[
+                    _s3_bucket_arn(bucket_name) + "/manifests/*",
+                    _s3_bucket_arn(bucket_name) + "/blobs/*",
+                ],
+            )
+        )
+        # Blobs are copied while the client waits
+        function_kwargs.update(timeout=900, memory_size=512)
+
+    assets = {
+        "lambda_function.py": pulumi.FileAsset("../app.py"),
+        "auth.py": pulumi.FileAsset("../auth.py"),
+        "bloom.py": pulumi.FileAsset("../bloom.py"),
+        "metrics.py": pulumi.FileAsset("../metrics.py"),
+    }
+    if AUTH_CONFIG["auth_jwks"]:
+        config.update((k, v) for k, v in AUTH_CONFIG.items() if v)
+        assets["jwks.json"] = pulumi.FileAsset(AUTH_CONFIG["auth_jwks"])
+        config["auth_jwks"] = "jwks.json"
+
+    archive = pulumi.AssetArchive({"config.ini": _make_config_ini(config), **assets})
+
+    role = lambda_iam_role(identifier, statements)
 
     function = lambda_.Function(
         identifier,
@@ -321,6 +479,7 @@ def registry_server(config):
         architectures=["x86_64"],
         runtime="python3.9",
         handler="lambda_function.lambda_handler",
+        **function_kwargs,
     )
 
     lambda_.FunctionUrl(
@@ -329,4 +488,9 @@ def registry_server(config):
 
 
 s3_lambda()
-Output.all(bucket=bucket.id, manifests=TABLE_NAMES["manifests"]).apply(registry_server)
+Output.all(
+    bucket=bucket.id,
+    manifests=TABLE_NAMES["manifests"],
+    repositories=TABLE_NAMES["repositories"],
+    blobs=TABLE_NAMES["blobs"],
+).apply(registry_server)
@@ -0,0 +1,159 @@
+"""Serves the registry's read path over HTTP from a long-running process.
+
+This runs the same routing as the read lambda (app.py), for hosts that sit next
+to build farms and serve many concurrent pulls. Requests are parsed on an
+asyncio event loop; the blocking AWS calls that routing makes run on a bounded
+thread pool sharing pooled connections, and identical manifest requests that
+are in flight at the same time share a single lookup. Most requests are
+answered from the read path's caches without an AWS call, so threads are only
+tied up by cache misses. Metrics are logged every --metrics-interval seconds
+rather than once per request.
+
+    python server.py --config config.ini --port 5000
+
+config.ini has the same [default] section as the read lambda's. Set
+s3_endpoint and dynamodb_endpoint to run against local stand-ins, and
+max_pool_connections to at least --workers.
+
+bench/http_server.py load-tests this against the stand-ins.
+"""
+import argparse
+import asyncio
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from os import environ
+from pathlib import Path
+from urllib.parse import urlsplit
+
+
+class Server:
+    def __init__(self, app, workers, metrics_interval=60.0):
+        self._app = app
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._inflight = dict()
+        self._metrics_interval = metrics_interval
+
+    async def _call(self, event):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._app.handle, event)
+
+    async def _single_flight(self, key, event):
+        """Routes `event`, sharing the work with identical requests in flight."""
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._call(event))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # Shielded so that one client disconnecting doesn't cancel the others
+        return await asyncio.shield(future)
+
+    async def respond(self, method, target, headers):
+        url = urlsplit(target)
+        event = dict(
+            requestContext=dict(http=dict(method=method, path=url.path)),
+            headers=headers,
+            rawQueryString=url.query,
+        )
+
+        if "/manifests/" not in url.path:
+            return await self._call(event)
+
+        # Responses depend on credentials, so only identical ones share a lookup
+        key = (
+            method,
+            url.path,
+            headers.get("if-none-match"),
+            headers.get("authorization"),
+        )
+        return await self._single_flight(key, event)
+
+    @staticmethod
+    def _serialize(method, response, keep_alive):
+        status = response["statusCode"]
+        body = b64decode(response["body"])
+        headers = dict(response["headers"])
+        headers.setdefault("Content-Length", str(len(body)))
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        if method == "HEAD" or status == 304:
+            return head
+        return head + body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, version = request_line.decode("latin-1").split()
+                headers = dict()
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # The read path has no use for request bodies, but must skip them
+                if length := int(headers.get("content-length", 0)):
+                    await reader.readexactly(length)
+
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                response = await self.respond(method, target, headers)
+                writer.write(self._serialize(method, response, keep_alive))
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Malformed requests and clients going away just end the connection
+            pass
+        finally:
+            writer.close()
+
+    async def _flush_metrics(self):
+        while True:
+            await asyncio.sleep(self._metrics_interval)
+            self._app.METRICS.flush()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        flusher = asyncio.ensure_future(self._flush_metrics())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            self._app.METRICS.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=Path, default=Path("config.ini"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--metrics-interval", type=float, default=60.0)
+    args = parser.parse_args()
+
+    # app.py reads its config from the Lambda task root
+    environ["LAMBDA_TASK_ROOT"] = str(args.config.resolve().parent)
+    if args.config.name != "config.ini":
+        parser.error("--config must point at a file named config.ini")
+
+    import app
+
+    server = Server(app, args.workers, args.metrics_interval)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""Rebuilds the index tables from the bucket.
+
+For when the tables are lost, migrated to a new schema, or have drifted after a
+bug. Manifests are described by the indexer's own code, so the rebuilt items
+match what live indexing writes.
+
+The rebuild only ever adds rows, so it must write into fresh, empty tables:
+stale references, deleted tags and forgotten repositories in existing tables
+would survive it, and phase 3 would count the stale references. To repair
+drifted tables, create new ones, rebuild into them and switch the functions
+over. A rebuild that isn't resuming from a checkpoint refuses to start if any
+table holds rows.
+
+    python tools/rebuild.py --config path/to/indexer/config.ini \\
+        --checkpoint rebuild.json --workers 64
+
+config.ini is the indexer's. Pause the indexer's notifications while this runs.
+The rebuild happens in three phases, each resumable from the checkpoint file:
+
+1. blobs: lists blobs/ and writes a row for every object, marked as found.
+2. manifests: lists manifests/, then fetches and describes every manifest and
+   batch-writes its items, its references in both directions and its
+   repository. Tag items are written without a sequencer, so any later event
+   applies on top of them.
+3. refcounts: scans in_references in parallel segments, counts each blob's
+   references and sets its refcount.
+
+Listings are split into key ranges that are paged through concurrently, and the
+checkpoint records the last key written in each range. Resume with the same
+--split-depth and --segments.
+"""
+import argparse
+import importlib
+import json
+import string
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from itertools import product
+from os import environ
+from os import replace
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Repository names start with these; anything else still falls in some range
+NAME_ALPHABET = string.digits + string.ascii_lowercase
+DIGEST_ALPHABET = string.digits + "abcdef"
+TABLES = ("blobs", "references", "in_references", "manifests", "repositories")
+
+
+class Checkpoint:
+    """Per-range progress, saved to a JSON file whenever it changes."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._state = json.loads(path.read_text()) if path.exists() else dict()
+
+    def started(self):
+        return bool(self._state)
+
+    def get(self, phase, part):
+        return self._state.get(phase, {}).get(str(part))
+
+    def set(self, phase, part, value):
+        with self._lock:
+            self._state.setdefault(phase, {})[str(part)] = value
+            tmp = self._path.with_name(self._path.name + ".tmp")
+            tmp.write_text(json.dumps(self._state))
+            replace(tmp, self._path)
+
+
+def key_ranges(prefix, split_prefix, alphabet, depth):
+    """Splits the keys under `prefix` into contiguous ranges, as (start, end)
+    pairs. Boundaries are `split_prefix` followed by `depth` characters of
+    `alphabet`; the first range starts at the beginning of `prefix` and the last
+    runs to its end."""
+
+    boundaries = sorted(
+        split_prefix + "".join(chars) for chars in product(alphabet, repeat=depth)
+    )
+    starts = [None] + boundaries
+    ends = boundaries + [None]
+    return list(zip(starts, ends))
+
+
+def list_range(indexer, prefix, start, end, resume_after=None):
+    """Yields pages of the objects under `prefix` in the key range [start, end).
+
+    A key equal to `start` itself is skipped, but boundaries are never whole
+    manifest names or digests.
+    """
+
+    kwargs = dict(Bucket=indexer.BUCKET_NAME, Prefix=prefix)
+    if resume_after or start:
+        kwargs["StartAfter"] = resume_after or start
+
+    paginator = indexer.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**kwargs):
+        contents = page.get("Contents", [])
+        objects = [o for o in contents if end is None or o["Key"] < end]
+        if objects:
+            yield objects
+        if len(objects) < len(contents):
+            return
+
+
+def _put(indexer, item):
+    return dict(PutRequest=dict(Item=indexer.marshal(item)))
+
+
+class Rebuild:
+    def __init__(self, indexer, checkpoint, args):
+        self._indexer = indexer
+        self._checkpoint = checkpoint
+        self._args = args
+        self._progress_lock = Lock()
+        self._progress = Counter()
+
+    def run_phase(self, phase, fn, parts):
+        """Runs `fn(part, resume_after)` for every part that isn't done yet."""
+
+        todo = [p for p in parts if self._checkpoint.get(phase, p[0]) is not True]
+        print(f"{phase}: {len(parts) - len(todo)} of {len(parts)} already done")
+
+        def run(part):
+            fn(part, self._checkpoint.get(phase, part[0]))
+            self._checkpoint.set(phase, part[0], True)
+            with self._progress_lock:
+                self._progress[phase] += 1
+                print(f"{phase}: {self._progress[phase]} of {len(todo)} done")
+            # Logs this range's AWS call metrics, and keeps them from piling up
+            self._indexer.METRICS.flush()
+
+        with ThreadPoolExecutor(max_workers=self._args.parallel) as pool:
+            list(pool.map(run, todo))
+
+    def blobs(self, part, resume_after):
+        i, (start, end) = part
+        indexer = self._indexer
+        for objects in list_range(indexer, "blobs/", start, end, resume_after):
+            rows = [
+                _put(
+                    indexer,
+                    dict(digest=o["Key"][len("blobs/") :], size=o["Size"], found=True),
+                )
+                for o in objects
+            ]
+            indexer.batch_write(indexer.TABLE_NAMES.blobs, rows)
+            self._checkpoint.set("blobs", i, objects[-1]["Key"])
+
+    def _fetch(self, key):
+        indexer = self._indexer
+        try:
+            resp = indexer.s3.get_object(Bucket=indexer.BUCKET_NAME, Key=key)
+        except indexer.s3.exceptions.NoSuchKey:
+            # Deleted since it was listed
+            return None
+
+        return resp["Body"].read()
+
+    def _write_manifests(self, names, bodies):
+        indexer = self._indexer
+        items = dict()
+        aliases = dict()
+        repositories = set()
+        edges = set()
+        for name, body in zip(names, bodies):
+            if body is None:
+                continue
+
+            try:
+                tag_item, alias_items, digests = indexer.ManifestHandlers.describe(
+                    body, name
+                )
+            except (ValueError, KeyError) as e:
+                print(f"Skipping {name}: {e!r}")
+                continue
+
+            items[name] = tag_item
+            for alias, alias_item in alias_items.items():
+                aliases.setdefault(alias, (alias_item, set()))[1].add(name)
+            repositories.add(name.split(":")[0])
+            edges.update((name, digest) for digest in digests)
+
+        found = indexer.Blob.batch_exists({digest for _, digest in edges})
+
+        tables = indexer.TABLE_NAMES
+        indexer.batch_write(
+            tables.in_references,
+            [_put(indexer, dict(digest=d, source=s)) for s, d in sorted(edges)],
+        )
+        indexer.batch_write(
+            tables.references,
+            [
+                _put(indexer, dict(source=s, digest=d, found=d in found))
+                for s, d in sorted(edges)
+            ],
+        )
+        indexer.batch_write(
+            tables.manifests, [_put(indexer, item) for item in items.values()]
+        )
+        # Tags that share a digest share its alias, which other parts may also be
+        # writing, so owners are added rather than put. Aliases lose to tags.
+        aliases = {a: v for a, v in aliases.items() if a not in items}
+        put_alias = indexer.ManifestHandlers.put_alias
+        list(indexer.POOL.map(lambda a: put_alias(a, *aliases[a]), aliases))
+        indexer.batch_write(
+            tables.repositories,
+            [
+                _put(indexer, dict(catalog=indexer.CATALOG, repository=repository))
+                for repository in sorted(repositories)
+            ],
+        )
+
+    def manifests(self, part, resume_after):
+        i, (start, end) = part
+        indexer = self._indexer
+        for objects in list_range(indexer, "manifests/", start, end, resume_after):
+            keys = [o["Key"] for o in objects]
+            bodies = list(indexer.POOL.map(self._fetch, keys))
+            names = [key[len("manifests/") :] for key in keys]
+            self._write_manifests(names, bodies)
+            self._checkpoint.set("manifests", i, keys[-1])
+
+    def _set_refcount(self, digest, refcount):
+        indexer = self._indexer
+        indexer.dynamodb_client.update_item(
+            TableName=indexer.TABLE_NAMES.blobs,
+            Key=dict(digest=dict(S=digest)),
+            # Like add_reference, a blob that was never uploaded isn't found
+            UpdateExpression="SET refcount = :n, #found = if_not_exists(#found, :f)",
+            ExpressionAttributeNames={"#found": "found"},
+            ExpressionAttributeValues={
+                ":n": dict(N=str(refcount)),
+                ":f": dict(BOOL=False),
+            },
+        )
+
+    def refcounts(self, part, resume_after):
+        """Counts the in_refs in one scan segment. Every in_ref of a digest is in
+        the same segment, since segments divide the partition key space."""
+
+        segment, _ = part
+        indexer = self._indexer
+        counts = Counter()
+        pages = indexer.dynamodb_client.get_paginator("scan").paginate(
+            TableName=indexer.TABLE_NAMES.in_references,
+            ProjectionExpression="digest",
+            Segment=segment,
+            TotalSegments=self._args.segments,
+        )
+        for page in pages:
+            counts.update(item["digest"]["S"] for item in page["Items"])
+
+        list(indexer.POOL.map(self._set_refcount, counts.keys(), counts.values()))
+
+
+def nonempty_tables(indexer):
+    """Returns the names of the tables that already hold rows."""
+
+    names = []
+    for table in TABLES:
+        name = indexer.TABLE_NAMES[table]
+        resp = indexer.dynamodb_client.scan(TableName=name, Limit=1, Select="COUNT")
+        if resp["Count"]:
+            names.append(name)
+
+    return names
+
+
+def load_indexer(config_path, workers):
+    """Imports lambda.py with its config, sized for `workers` concurrent calls."""
+
+    parser = ConfigParser()
+    parser.read(config_path)
+    parser["default"]["max_workers"] = str(workers)
+
+    task_root = Path(mkdtemp(prefix="registry-rebuild-"))
+    with open(task_root / "config.ini", "w") as f:
+        parser.write(f)
+    environ["LAMBDA_TASK_ROOT"] = str(task_root)
+
+    sys.path.insert(0, str(ROOT))
+    return importlib.import_module("lambda")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=Path, required=True)
+    parser.add_argument("--checkpoint", type=Path, default=Path("rebuild.json"))
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--parallel", type=int, default=32)
+    parser.add_argument("--split-depth", type=int, default=2)
+    parser.add_argument("--segments", type=int, default=256)
+    parser.add_argument(
+        "--phases", nargs="+", default=["blobs", "manifests", "refcounts"]
+    )
+    args = parser.parse_args()
+
+    indexer = load_indexer(args.config, args.workers)
+    checkpoint = Checkpoint(args.checkpoint)
+    if not checkpoint.started() and {"blobs", "manifests"} & set(args.phases):
+        if names := nonempty_tables(indexer):
+            raise SystemExit(
+                f"{', '.join(names)} already hold rows, which a rebuild can't "
+                "remove. Rebuild into fresh tables."
+            )
+
+    rebuild = Rebuild(indexer, checkpoint, args)
+
+    depth = args.split_depth
+    phases = dict(
+        blobs=key_ranges("blobs/", "blobs/sha256:", DIGEST_ALPHABET, depth),
+        manifests=key_ranges("manifests/", "manifests/", NAME_ALPHABET, depth),
+        refcounts=[None] * args.segments,
+    )
+    for phase in args.phases:
+        parts = list(enumerate(phases[phase]))
+        rebuild.run_phase(phase, getattr(rebuild, phase), parts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Deletes blobs that no manifest references, by mark and sweep.
+
+Refcounting only collects a blob when a manifest that referenced it goes away.
+Blobs uploaded without a manifest, left behind by failed pushes, or leaked by
+earlier bugs are never collected by it, but this sweep finds them:
+
+    python tools/sweep.py --config path/to/indexer/config.ini --dry-run
+    python tools/sweep.py --config path/to/indexer/config.ini --grace-hours 48
+
+Mark: in_references is scanned in parallel segments and its digests are
+external-sorted into runs on disk. Sweep: the runs are merged into one sorted
+stream and joined against the listing of blobs/, which S3 returns in key order,
+so memory stays bounded however large the registry is.
+
+Orphans younger than the grace period are kept, since pushes upload blobs
+before their manifests. The rest are rechecked with a consistent read, then
+deleted the way refcounting deletes blobs: conditionally on their rows, then
+from S3 with delete_objects. A refcount that leaked above zero is read before
+the recheck, and the row is deleted only if the count hasn't risen since, as it
+would have if a reference had appeared. Orphans that couldn't be deleted are
+listed.
+"""
+import argparse
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from itertools import groupby
+from pathlib import Path
+from tempfile import mkdtemp
+
+from rebuild import load_indexer
+
+
+def _write_run(directory, digests):
+    path = directory / f"run-{len(list(directory.iterdir()))}"
+    path.write_text("".join(d + "\n" for d in sorted(set(digests))))
+    return path
+
+
+def mark(indexer, args, directory):
+    """Writes the digests of every in_ref to sorted runs. Returns their paths."""
+
+    def scan_segment(segment):
+        # Each segment writes its own runs, so they need unique names
+        segment_dir = directory / str(segment)
+        segment_dir.mkdir()
+        runs = []
+        buffered = []
+        pages = indexer.dynamodb_client.get_paginator("scan").paginate(
+            TableName=indexer.TABLE_NAMES.in_references,
+            ProjectionExpression="digest",
+            Segment=segment,
+            TotalSegments=args.segments,
+        )
+        for page in pages:
+            buffered.extend(item["digest"]["S"] for item in page["Items"])
+            if len(buffered) >= args.run_size:
+                runs.append(_write_run(segment_dir, buffered))
+                buffered = []
+
+        if buffered:
+            runs.append(_write_run(segment_dir, buffered))
+        return runs
+
+    with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        segments = pool.map(scan_segment, range(args.segments))
+        return [run for runs in segments for run in runs]
+
+
+def referenced_digests(runs):
+    """Yields every referenced digest once, in sorted order."""
+
+    files = [open(run) for run in runs]
+    try:
+        merged = heapq.merge(*(map(str.rstrip, f) for f in files))
+        for digest, _ in groupby(merged):
+            yield digest
+    finally:
+        for f in files:
+            f.close()
+
+
+def listed_blobs(indexer):
+    paginator = indexer.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=indexer.BUCKET_NAME, Prefix="blobs/"):
+        yield from page.get("Contents", [])
+
+
+def unreferenced_blobs(listing, referenced):
+    """Joins two sorted streams, yielding the listed blobs with no reference."""
+
+    ref = next(referenced, None)
+    for obj in listing:
+        digest = obj["Key"][len("blobs/") :]
+        while ref is not None and ref < digest:
+            ref = next(referenced, None)
+        if ref != digest:
+            yield digest, obj
+
+
+class Report:
+    def __init__(self):
+        self.listed = 0
+        self.too_young = 0
+        self.orphans = 0
+        self.orphan_bytes = 0
+        self.leaked = 0
+        self.deleted = 0
+        self.deleted_bytes = 0
+        self.kept = 0
+
+    def __str__(self):
+        return (
+            f"{self.listed} blobs listed, {self.orphans} orphans "
+            f"({self.orphan_bytes} bytes, {self.leaked} with leaked refcounts), "
+            f"{self.too_young} within the grace period, "
+            f"{self.deleted} deleted ({self.deleted_bytes} bytes), "
+            f"{self.kept} referenced since they were checked"
+        )
+
+
+def sweep(indexer, args, runs, report):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=args.grace_hours)
+
+    def counted(listing):
+        for obj in listing:
+            report.listed += 1
+            yield obj
+
+    def flush(batch):
+        digests = list(batch)
+        # Read first: a reference made after the recheck also raises the count
+        refcounts = list(indexer.POOL.map(indexer.Blob.refcount, digests))
+        # The mark phase is a moment behind; a reference may have appeared since
+        unreferenced = indexer.POOL.map(indexer.Blob.is_unreferenced, digests)
+        orphans = {d: batch[d] for d, u in zip(digests, unreferenced) if u}
+        seen = {d: n for d, n in zip(digests, refcounts) if d in orphans and n > 0}
+        report.orphans += len(orphans)
+        report.orphan_bytes += sum(orphans.values())
+        report.leaked += len(seen)
+
+        if args.dry_run:
+            for digest, size in orphans.items():
+                print(f"orphan {digest} {size} refcount {seen.get(digest, 0)}")
+        else:
+            deleted = set(indexer.Blob.batch_delete(list(orphans), seen))
+            for digest, size in orphans.items():
+                if digest in deleted:
+                    report.deleted += 1
+                    report.deleted_bytes += size
+                else:
+                    report.kept += 1
+                    print(f"kept {digest}: referenced since it was checked")
+
+        # Logs this batch's AWS call metrics, and keeps them from piling up
+        indexer.METRICS.flush()
+
+    batch = dict()
+    listing = counted(listed_blobs(indexer))
+    for digest, obj in unreferenced_blobs(listing, referenced_digests(runs)):
+        if obj["LastModified"] > cutoff:
+            report.too_young += 1
+            continue
+
+        batch[digest] = obj["Size"]
+        if len(batch) == 1000:
+            flush(batch)
+            batch = dict()
+
+    if batch:
+        flush(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=Path, required=True)
+    parser.add_argument("--grace-hours", type=float, default=24.0)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--parallel", type=int, default=16)
+    parser.add_argument("--segments", type=int, default=64)
+    parser.add_argument(
+        "--run-size", type=int, default=1_000_000, help="digests per sorted run"
+    )
+    args = parser.parse_args()
+
+    indexer = load_indexer(args.config, args.workers)
+    runs = mark(indexer, args, Path(mkdtemp(prefix="registry-sweep-")))
+
+    report = Report()
+    sweep(indexer, args, runs, report)
+    indexer.METRICS.flush()
+    print(report)
+
+
+if __name__ == "__main__":
+    main()